@@ -5,6 +5,8 @@
 
 import datetime as dt
 import sqlalchemy as db
+import functools
+import os
 import pathlib
 import re
 
@@ -13,25 +15,90 @@ sys.path.append(pathlib.Path(__file__).parent.resolve())
 from space_track_credentials import amisr_dbfile_path
 
 
+# Schema of the tables used from the AMISR experiment database
+# These are declared here rather than reflected from the database so the schema doesn't have to be
+#   re-read every time a database is opened
+metadata = db.MetaData()
+
+experiment_table = db.Table('experiment', metadata,
+                            db.Column('experiment', db.String),
+                            db.Column('mode', db.String),
+                            db.Column('start_time', db.Float),
+                            db.Column('end_time', db.Float),
+                            db.Index('ix_experiment_start_end', 'start_time', 'end_time'))
+
+site_table = db.Table('site', metadata,
+                      db.Column('shortname', db.String),
+                      db.Column('latitude', db.Float),
+                      db.Column('longitude', db.Float))
+
+
+# find all AMISR experiments that fall within specified time
+# the redundant lower bound on start_time lets SQLite do a single range scan on the start_time index
+#   rather than checking end_time for every experiment that started before the end of the period
+# The query is the same for every radar, so it is only built once
+experiment_query = db.select([experiment_table.columns.experiment, experiment_table.columns.mode, experiment_table.columns.start_time, experiment_table.columns.end_time]).where(
+    db.and_(experiment_table.columns.start_time>=db.bindparam('earliest_start'), experiment_table.columns.start_time<db.bindparam('endtime'), experiment_table.columns.end_time>db.bindparam('starttime')))
+
+
+def amisr_dbfile(radar):
+    # AMISR experiment database file for a radar
+    return amisr_dbfile_path+'{}_only_experiment_info.db'.format(radar)
+
+
+@functools.lru_cache(maxsize=None)
+def amisr_engine(radar):
+    # Create (once per radar) the engine for the AMISR experiment database
+    engine = db.create_engine('sqlite:///'+amisr_dbfile(radar))
+
+    # index the experiment times so find_experiments() can use a range scan instead of a full table scan
+    try:
+        with engine.begin() as conn:
+            conn.execute(db.text('CREATE INDEX IF NOT EXISTS ix_experiment_start_end ON experiment (start_time, end_time)'))
+    except db.exc.OperationalError:
+        # database may be read-only - queries still work, just without the index
+        pass
+
+    return engine
+
+
+def amisr_max_duration(radar):
+    # Longest experiment in the database (s) - bounds how early an experiment overlapping a period can start
+    # The MAX(end_time-start_time) query has to read every experiment (no index covers the expression), so it is
+    #   only run once per radar rather than for every AMISR_lookup.  The cached value is keyed on the modification
+    #   time of the database file, so it is queried again if the database is updated during a long run.
+    try:
+        mtime = os.stat(amisr_dbfile(radar)).st_mtime_ns
+    except OSError:
+        mtime = None
+    return _amisr_max_duration(radar, mtime)
+
+
+@functools.lru_cache(maxsize=16)
+def _amisr_max_duration(radar, mtime):
+    with amisr_engine(radar).connect() as conn:
+        return conn.execute(db.select([db.func.max(experiment_table.columns.end_time-experiment_table.columns.start_time)])).scalar() or 0.
+
+
 class AMISR_lookup(object):
+    # Use as a context manager (or call close()) so the database connection is released:
+    #   with AMISR_lookup('RISRN') as al:
+    #       exp_list = al.find_experiments(starttime, endtime)
 
     def __init__(self, radar):
         self.radar = radar
-        # find all AMISR experiments files that fall within specified time
-        self.engine = db.create_engine('sqlite:///'+amisr_dbfile_path+'{}_only_experiment_info.db'.format(radar))
-        # with engine.connect() as conn:
+        self.engine = amisr_engine(radar)
         self.conn = self.engine.connect()
-        self.exp = db.Table('experiment', db.MetaData(), autoload=True, autoload_with=self.engine)
-        self.params = [self.exp.columns.experiment, self.exp.columns.mode, self.exp.columns.start_time, self.exp.columns.end_time]
+
+        # longest experiment in the database - bounds how early an experiment overlapping a period can start
+        self.max_duration = amisr_max_duration(radar)
 
     def find_experiments(self, starttime, endtime):
         unixstarttime = (starttime-dt.datetime.utcfromtimestamp(0)).total_seconds()
         unixendtime = (endtime-dt.datetime.utcfromtimestamp(0)).total_seconds()
 
         # queary AMISR database for experiments in this time frame
-        condition = db.and_(self.exp.columns.end_time>unixstarttime, self.exp.columns.start_time<unixendtime)
-        query = db.select(self.params).where(condition)
-        exp_list = self.conn.execute(query).fetchall()
+        exp_list = self.conn.execute(experiment_query, {'earliest_start':unixstarttime-self.max_duration, 'starttime':unixstarttime, 'endtime':unixendtime}).fetchall()
 
         return [{'experiment_number':exp.experiment, 'mode':exp.mode, 'start_time':exp.start_time, 'end_time':exp.end_time} for exp in exp_list]
 
@@ -117,11 +184,17 @@ class AMISR_lookup(object):
 
 
     def site_coords(self):
-        site = db.Table('site', db.MetaData(), autoload=True, autoload_with=self.engine)
+        site = site_table
         query = db.select([site.columns.latitude, site.columns.longitude]).where(site.columns.shortname==self.radar.lower())
         radar_site = self.conn.execute(query).fetchall()[0]
         return radar_site
 
 
-    def __del__(self):
+    def close(self):
         self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -21,7 +21,7 @@ import cartopy.crs as ccrs
 
 
 # def conjunctions(starttime, endtime, radar, sid, deltime=60., conjtype='zenith', tolerance=25., conjcoords='geo'):
-def conjunctions(starttime, endtime, radar, sid, **sat_conj_kwarg):
+def conjunctions(starttime, endtime, radar, sid, positions=True, **sat_conj_kwarg):
     # returns a list of conjuctions between a satellite (SID is the NORAD satellite ID) and ground-based AMISR (when the radar
     #    is running) as well as information about the radar experiment and mode
     # Input:
@@ -29,41 +29,61 @@ def conjunctions(starttime, endtime, radar, sid, **sat_conj_kwarg):
     #   endtime = end of time period to be considered
     #   radar = AMISR to find conjuncitons with
     #   sid = NORAD satellite ID (space-track.org has a search tool)
+    #   positions = whether to return satellite positions for each pass (False if only the pass times are needed)
     #   Also will take any optional keyword arguments for the SatConj class
 
     # Create AMISR_looup object
-    al = amisr_lookup.AMISR_lookup(radar)
+    with amisr_lookup.AMISR_lookup(radar) as al:
+        radar_site = al.site_coords()
+
+        # Get list of all AMISR experiments in specified time frame
+        exp_list = al.find_experiments(starttime, endtime)
 
     # Initialize satellite conjunciton instance
-    radar_site = al.site_coords()
     conj = satellite_conjunction.SatConj(radar_site[0], radar_site[1], 0., sid, **sat_conj_kwarg)
 
-    # Get list of all AMISR experiments in specified time frame
-    exp_list = al.find_experiments(starttime, endtime)
-
     # Find passes within each experiment
-    pass_list = []
-    for exp in exp_list:
-
-        exp_start = dt.datetime.utcfromtimestamp(exp['start_time'])
-        exp_end = dt.datetime.utcfromtimestamp(exp['end_time'])
-
-        passes = conj.conjunctions(exp_start, exp_end)
+    # The sample times for all experiments are combined (labeled by experiment) and checked in a single pass, so the
+    #   TLE propagation and conjunction search are only set up once rather than once per experiment
+    exp_list = sorted(exp_list, key=lambda exp: exp['start_time'])
+    if not exp_list:
+        return []
+    # the combined grid is filled in one preallocated array rather than building a separate time array for each
+    #   experiment and concatenating them (the times are the same as np.arange(start_time, end_time, deltime))
+    exp_start = np.array([exp['start_time'] for exp in exp_list])
+    exp_end = np.array([exp['end_time'] for exp in exp_list])
+    exp_nsteps = np.maximum(np.ceil((exp_end-exp_start)/conj.deltime), 0).astype(int)
+    exp_idx = np.repeat(np.arange(len(exp_list)), exp_nsteps)
+    step = np.arange(len(exp_idx)) - np.repeat(np.cumsum(exp_nsteps)-exp_nsteps, exp_nsteps)
+    unix_time_array = exp_start[exp_idx] + step*conj.deltime
+
+    pass_list = conj.conjunctions_grid(unix_time_array, segment=exp_idx, positions=positions)
+
+    for p in pass_list:
+        exp = exp_list[p.pop('segment')]
+        p.update({'mode':exp['mode'], 'experiment':exp['experiment_number']})
 
-        for p in passes:
-            p.update({'mode':exp['mode'], 'experiment':exp['experiment_number']})
+    return pass_list
 
-        pass_list.extend(passes)
 
-    return pass_list
+def sat_conj_options(deltime, zatol, latlontol, conjcoords):
+    # translate the validate/output_file conjunction options into SatConj keyword arguments
+    # conjunctions are found within a lat/lon box if latlontol is given, otherwise within zatol of zenith
+    if latlontol is None:
+        return {'deltime':deltime, 'conjtype':'zenith', 'tolerance':zatol, 'coords':conjcoords}
+    else:
+        return {'deltime':deltime, 'conjtype':'latlon', 'tolerance':latlontol, 'coords':conjcoords}
 
 
-def validate(starttime, endtime, radar, sid, deltime=60., zatol=25., latlontol=None, conjcoords='geo'):
+def validate(starttime, endtime, radar, sid, deltime=60., zatol=25., latlontol=None, conjcoords='geo', passes=None):
+    # passes = list of passes already returned by conjunctions() for these options (with positions), so they don't
+    #   have to be found again - if None, conjunctions() is called
 
-    passes = conjunctions(starttime, endtime, radar, sid, deltime=deltime, lattol=lattol, lontol=lontol, conjcoords=conjcoords, return_all=True)
+    if passes is None:
+        passes = conjunctions(starttime, endtime, radar, sid, **sat_conj_options(deltime, zatol, latlontol, conjcoords))
 
-    mode = am.AMISR_mode(radar)
-    radar_site = mode.site_coords()
+    with amisr_lookup.AMISR_lookup(radar) as al:
+        radar_site = al.site_coords()
 
 
     mapproj = ccrs.LambertConformal(central_latitude=radar_site.latitude, central_longitude=radar_site.longitude)
@@ -75,24 +95,28 @@ def validate(starttime, endtime, radar, sid, deltime=60., zatol=25., latlontol=N
         ax.gridlines()
         # ax.set_extent([radar_site.longitude-lontol, radar_site.longitude+lontol, radar_site.latitude-lattol, radar_site.latitude+lattol])
 
-        lat, lon, _ = pm.ecef2geodetic(p['position'][0], p['position'][1], p['position'][2])
+        lat, lon, _ = pm.ecef2geodetic(p['position'][:,0], p['position'][:,1], p['position'][:,2])
 
         ax.plot(lon, lat, transform=ccrs.Geodetic())
         ax.scatter(lon, lat, transform=ccrs.Geodetic())
         ax.scatter(radar_site.longitude, radar_site.latitude, marker='^', s=100, transform=ccrs.Geodetic())
 
-        ax.set_title('{}, {}'.format(p['APT'],sid))
+        ax.set_title('{}, {}'.format(p['time'][0],sid))
 
-        fig.savefig('conjvalid_{:%Y%m%d_%H%M%S}.png'.format(p['APT']))
+        fig.savefig('conjvalid_{:%Y%m%d_%H%M%S}.png'.format(p['time'][0]))
         plt.close(fig)
 
-def output_file(starttime, endtime, radar, sid, deltime=60., zatol=25., latlontol=None, conjcoords='geo', filename='conjunctions.txt'):
+def output_file(starttime, endtime, radar, sid, deltime=60., zatol=25., latlontol=None, conjcoords='geo', filename='conjunctions.txt', passes=None):
+    # passes = list of passes already returned by conjunctions() for these options, so they don't have to be found
+    #   again - if None, conjunctions() is called
 
-    passes = conjunctions(starttime, endtime, radar, sid, deltime=deltime, lattol=lattol, lontol=lontol, conjcoords=conjcoords, return_all=True)
+    # only the pass times are written, so don't assemble satellite positions
+    if passes is None:
+        passes = conjunctions(starttime, endtime, radar, sid, positions=False, **sat_conj_options(deltime, zatol, latlontol, conjcoords))
 
     with open(filename, 'w') as f:
         for p in passes:
-            f.write('{:%Y-%m-%d %H:%M:%S}    {}\n'.format(p['APT'], p['mode']))
+            f.write('{:%Y-%m-%d %H:%M:%S}    {}\n'.format(p['time'][0], p['mode']))
 
 def main():
     st = dt.datetime(2017,10,1,0,0,0)
@@ -104,11 +128,12 @@ def main():
     # sid = 25991     # SID for F15;
     sid = 39265     # SID for CASSIOPE/ePOP
 
+    # find the passes once and reuse them for the validation plots and output file
     passes = conjunctions(st, et, 'RISRN', sid)
     print(passes)
 
-    # validate(st, et, 'RISRN', sid)
-    # output_file(st, et, 'RISRN', sid)
+    # validate(st, et, 'RISRN', sid, passes=passes)
+    # output_file(st, et, 'RISRN', sid, passes=passes)
 
 
 if __name__=='__main__':
@@ -0,0 +1,155 @@
+# apex_utils.py
+# Cached Apex objects and site base vectors for magnetic coordinate calculations.
+# Initializing an Apex object loads and interpolates the IGRF coefficients, so they are created once per
+#   year and reused rather than being set up for every conjunction or ephemeris calculation.
+# Requires apexpy (https://apexpy.readthedocs.io/en/latest/readme.html) and numba
+
+import functools
+import numpy as np
+import pymap3d as pm
+from apexpy import Apex
+from numba import njit, prange
+
+
+@functools.lru_cache(maxsize=8)
+def apex(year):
+    # return the Apex object for a particular year
+    return Apex(date=year)
+
+
+def site_basevectors(year, lat, lon, alt):
+    # return the apex base vectors (d1, d2, d3, e1, e2, e3) at a site (geodetic lat/lon, alt in km)
+    # site coordinates are rounded so small floating point differences still hit the cache
+    return _site_basevectors(year, round(lat,4), round(lon,4), round(alt,4))
+
+
+@functools.lru_cache(maxsize=32)
+def _site_basevectors(year, lat, lon, alt):
+    _,_,_,_,_,_,d1,d2,d3,e1,e2,e3 = apex(year).basevectors_apex(lat, lon, alt)
+    return d1, d2, d3, e1, e2, e3
+
+
+def site_apex_zenith(year, lat, lon, alt):
+    # return the apex latitude and longitude of a site (geodetic lat/lon, alt in km) and the ECEF unit vector along
+    #   the e3 base vector (the magnetic "zenith") there
+    # like site_basevectors() this is cached by site, so the apex conversion and the vector rotation are only done
+    #   once per year and site however many conjunction searches use them
+    return _site_apex_zenith(year, round(lat,4), round(lon,4), round(alt,4))
+
+
+@functools.lru_cache(maxsize=32)
+def _site_apex_zenith(year, lat, lon, alt):
+    alat, alon = apex(year).geo2apex(lat, lon, alt)
+    _, _, _, _, _, e3 = _site_basevectors(year, lat, lon, alt)
+    zen_vec = np.array(pm.enu2uvw(e3[0], e3[1], e3[2], lat, lon))
+    zen_vec = zen_vec/np.linalg.norm(zen_vec)
+    # the cached vector is shared by every caller, so it is made read-only
+    zen_vec.flags.writeable = False
+    return alat, alon, zen_vec
+
+
+# Apex coordinates of many points (for example every satellite position in a conjunction search) are interpolated
+#   from a grid rather than being traced by apexpy for each point
+# The grid is in geodetic lat/lon (degrees) and height (km), and holds the apex coordinates as unit vectors so the
+#   interpolation is smooth near the magnetic pole, where apex longitude changes quickly.  Grid cells the apex
+#   coordinates are discontinuous across (near the magnetic equator) are marked and those points are converted
+#   with apexpy directly.  Away from those cells the interpolated coordinates are within about 0.01 degrees.
+apex_grid_res = 1.          # lat/lon grid spacing (degrees)
+apex_grid_dheight = 50.     # height grid spacing (km)
+apex_grid_maxangle = 2.     # cells whose corner apex coordinates are further apart than this (degrees) are not interpolated
+
+
+def geo2apex(year, lat, lon, height):
+    # return apex latitude and longitude (degrees) for geodetic lat/lon (degrees) and height (km) in year
+    shape = np.broadcast(lat, lon, height).shape
+    lat, lon, height = [np.ascontiguousarray(np.broadcast_to(np.asarray(c, dtype=np.float64), shape)).ravel() for c in (lat, lon, height)]
+    if not lat.size:
+        return lat.reshape(shape), lon.reshape(shape)
+
+    hmin = np.floor(np.nanmin(height)/apex_grid_dheight)*apex_grid_dheight
+    hmax = max(np.ceil(np.nanmax(height)/apex_grid_dheight)*apex_grid_dheight, hmin+apex_grid_dheight)
+
+    # for fewer points than the grid has, it's faster to convert them directly
+    nlat = int(round(180./apex_grid_res))+1
+    nlon = int(round(360./apex_grid_res))+1
+    nheight = int(round((hmax-hmin)/apex_grid_dheight))+1
+    if lat.size < nlat*nlon*nheight:
+        alat, alon = apex(year).geo2apex(lat, lon, height)
+        return np.reshape(alat, shape), np.reshape(alon, shape)
+
+    grid, cell_ok = _apex_grid(year, hmin, hmax)
+    alat = np.empty_like(lat)
+    alon = np.empty_like(lat)
+    ok = np.empty(lat.shape, dtype=np.bool_)
+    _interp_apex_grid(grid, cell_ok, hmin, lat, lon, height, apex_grid_res, apex_grid_dheight, alat, alon, ok)
+
+    if not ok.all():
+        alat[~ok], alon[~ok] = apex(year).geo2apex(lat[~ok], lon[~ok], height[~ok])
+
+    return alat.reshape(shape), alon.reshape(shape)
+
+
+@functools.lru_cache(maxsize=4)
+def _apex_grid(year, hmin, hmax):
+    # apex coordinates on the lat/lon/height grid as (nlat, nlon, nheight, 3) unit vectors, and whether each grid
+    #   cell can be interpolated
+    glat = np.linspace(-90., 90., int(round(180./apex_grid_res))+1)
+    glon = np.linspace(-180., 180., int(round(360./apex_grid_res))+1)
+    gheight = np.linspace(hmin, hmax, int(round((hmax-hmin)/apex_grid_dheight))+1)
+    G = np.meshgrid(glat, glon, gheight, indexing='ij')
+    alat, alon = apex(year).geo2apex(G[0], G[1], G[2])
+
+    alat = np.radians(alat)
+    alon = np.radians(alon)
+    grid = np.stack([np.cos(alat)*np.cos(alon), np.cos(alat)*np.sin(alon), np.sin(alat)], axis=-1)
+
+    # a cell can be interpolated if the coordinates at all its corners are close to those at its first corner
+    #   (NaN corners also fail this)
+    corner = grid[:-1,:-1,:-1]
+    cos_max = np.cos(np.radians(apex_grid_maxangle))
+    cell_ok = np.ones(corner.shape[:-1], dtype=np.bool_)
+    for di in (0, 1):
+        for dj in (0, 1):
+            for dk in (0, 1):
+                cell_ok &= np.einsum('...i,...i->...', grid[di:di+corner.shape[0],dj:dj+corner.shape[1],dk:dk+corner.shape[2]], corner) >= cos_max
+
+    return np.ascontiguousarray(grid), cell_ok
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _interp_apex_grid(grid, cell_ok, hmin, lat, lon, height, res, dheight, alat, alon, ok):
+    # trilinear interpolation of the apex unit vectors at each point, in a single parallel loop
+    ni = cell_ok.shape[0]
+    nj = cell_ok.shape[1]
+    nk = cell_ok.shape[2]
+    for n in prange(lat.size):
+        fi = (lat[n]+90.)/res
+        fj = ((lon[n]+180.) % 360.)/res
+        fk = (height[n]-hmin)/dheight
+        i = min(max(int(np.floor(fi)), 0), ni-1)
+        j = min(max(int(np.floor(fj)), 0), nj-1)
+        k = min(max(int(np.floor(fk)), 0), nk-1)
+
+        if not cell_ok[i,j,k]:
+            ok[n] = False
+            continue
+        ok[n] = True
+
+        a = fi-i
+        b = fj-j
+        c = fk-k
+        ux = 0.
+        uy = 0.
+        uz = 0.
+        for di in range(2):
+            wi = a if di else 1.-a
+            for dj in range(2):
+                wj = b if dj else 1.-b
+                for dk in range(2):
+                    w = wi*wj*(c if dk else 1.-c)
+                    ux += w*grid[i+di,j+dj,k+dk,0]
+                    uy += w*grid[i+di,j+dj,k+dk,1]
+                    uz += w*grid[i+di,j+dj,k+dk,2]
+
+        alat[n] = np.degrees(np.arctan2(uz, np.sqrt(ux*ux+uy*uy)))
+        alon[n] = np.degrees(np.arctan2(uy, ux))
@@ -0,0 +1,42 @@
+# cache_utils.py
+# Helpers for the files cached on disk (TLE libraries, TLE periods, the PRN mapping table)
+
+import numpy as np
+import contextlib
+import os
+import pathlib
+import tempfile
+import zipfile
+
+
+# Errors np.load raises for a cache file that is missing, empty (EOFError), truncated or corrupt (BadZipFile,
+#   ValueError) or from an older layout (KeyError) - any of these is treated as a cache miss
+cache_load_errors = (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile)
+
+
+@contextlib.contextmanager
+def atomic_write(cache_file):
+    # Open a temporary file in the same directory as cache_file for writing (binary), and move it into place once
+    #   the with block finishes, so a run that is interrupted part way through (or another process reading the cache
+    #   at the same time) never sees a partially written file
+    # If the with block raises, the temporary file is removed and cache_file is left as it was
+    cache_file = pathlib.Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=cache_file.parent, prefix=cache_file.name+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+def save_npz_cache(cache_file, compressed=False, **arrays):
+    # Write arrays to an .npz cache file with atomic_write()
+    # np.savez appends .npz to file names that don't already end in it, so this writes through the open file
+    with atomic_write(cache_file) as f:
+        if compressed:
+            np.savez_compressed(f, **arrays)
+        else:
+            np.savez(f, **arrays)
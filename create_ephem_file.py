@@ -3,13 +3,10 @@
 
 import numpy as np
 import datetime as dt
-from propagate_tle import propagate_tle
+from propagate_tle import propagate_tle_set, closest_epoch_index, ecef2geodetic
+from tle_cache import get_tles
 import pymap3d as pm
-from apexpy import Apex
-from spacetrack import SpaceTrackClient
-import spacetrack.operators as op
-
-from space_track_credentials import *
+from apex_utils import apex, site_basevectors
 
 
 
@@ -21,53 +18,33 @@ sid = 39265         # NORAD satellite ID
 outcomp = ['Unix Time','X','Y','Z','GDLAT','GDLON','GDALT','AZ','EL']
 outfile = 'CERTO_ephem.txt'
 site = [74.746627, 264.997469, 0.0]     # geodetic corrdinates for site - only nessisary if calcualting az/el
+backend = 'sgp4'    # TLE propagator - 'sgp4' (C SGP4 library) or 'dsgp4' (PyTorch batch propagation, see propagate_tle_batch.py)
 
 
-startdate = starttime.date()
-enddate = endtime.date()
-
-# if start and end times on the same date, advance enddate by one day
-if startdate==enddate:
-    enddate = enddate + dt.timedelta(days=1)
-
-# retrieve TLEs for entire period from space-track.org
-st = SpaceTrackClient(identity=ST_USERNAME, password=ST_PASSWORD)
-output = st.tle(norad_cat_id=sid, orderby='epoch asc', epoch=op.inclusive_range(startdate,enddate), format='tle')
-
-# parse output into list of distinct TLEs
-split = output.splitlines()
-TLE_list = [[split[2*i],split[2*i+1]] for i in range(len(split)//2)]
-
-# extract epoch from each TLE
-TLE_epoch = [dt.datetime.strptime(tle[0][18:23],'%y%j')+dt.timedelta(days=float(tle[0][23:32])) for tle in TLE_list]
-unix_TLE_epoch = np.array([(t-dt.datetime.utcfromtimestamp(0)).total_seconds() for t in TLE_epoch])
+# retrieve TLEs for entire period (from space-track.org or the local cache)
+TLE_list, TLE_epoch = get_tles(sid, starttime.date(), endtime.date(), return_epoch=True)
 
 # form array of times to find the satellite location
-unix_time_array = (starttime-dt.datetime.utcfromtimestamp(0)).total_seconds()+np.arange(0,(endtime-starttime).total_seconds(),deltime)
-time_array = np.array([dt.datetime.utcfromtimestamp(ut) for ut in unix_time_array])
+# the times are formed as a datetime64 array with numpy arithmetic rather than a datetime object per time
+time_step = np.round(np.arange(0, (endtime-starttime)/dt.timedelta(seconds=1), deltime)*1.e6).astype('timedelta64[us]')
+time_array = np.datetime64(starttime, 'us') + time_step
+unix_time_array = (time_array - np.datetime64(0, 'us'))/np.timedelta64(1, 's')
 
 # Find index of epoch closest to each time in the time array
-# this works, but causes HUGE memory problems when arrays large (when trying to find conjunctions for years at a time)
-# closest_epoch = np.argmin(np.abs(unix_time_array[:,None] - unix_TLE_epoch[None,:]), axis=-1)
-closest_epoch = np.array([np.argmin(np.abs(ut-unix_TLE_epoch)) for ut in unix_time_array])
-
+closest_epoch = closest_epoch_index(time_array, TLE_epoch)
 
-x = np.empty((0,))
-y = np.empty((0,))
-z = np.empty((0,))
-for i in range(len(TLE_epoch)):
-    subset_times = time_array[closest_epoch==i]
 
-    # calcualte satellite position using functions from TLE propgation script
-    x0, y0, z0 = propagate_tle(subset_times,TLE_list[i])
-    x = np.concatenate((x,x0))
-    y = np.concatenate((y,y0))
-    z = np.concatenate((z,z0))
+# calcualte satellite position using functions from TLE propgation script
+if backend == 'dsgp4':
+    from propagate_tle_batch import propagate_tle_batch
+    x, y, z = propagate_tle_batch(time_array, TLE_list, closest_epoch)
+else:
+    x, y, z = propagate_tle_set(time_array, TLE_list, closest_epoch)
 
 output = {'Unix Time':unix_time_array, 'X':x, 'Y':y, 'Z':z}
 
 # convert to geodetic coordinates
-gdlat, gdlon, gdalt = pm.ecef2geodetic(x, y, z)
+gdlat, gdlon, gdalt = ecef2geodetic(x, y, z)
 if any(i in outcomp for i in ['GDLAT','GDLON','GDALT']):
     output.update({'GDLAT':gdlat, 'GDLON':gdlon, 'GDALT':gdalt})
 
@@ -77,21 +54,29 @@ if any(i in outcomp for i in ['AZ', 'EL', 'ZENITH']):
     output.update({'AZ':az, 'EL':el, 'ZENITH':90.-el})
 
 # convert to Apex coordinates
-A = Apex(starttime)
+A = apex(starttime.year)
 if any(i in outcomp for i in ['ALAT','ALON']):
     alat, alon = A.geo2apex(gdlat, gdlon, height=gdalt/1000.)
     output.update({'ALAT':alat, 'ALON':alon})
 
 # conver to magnetic az/el
 if any(i in outcomp for i in ['MAGAZ','MAGEL','MAGZ']):
+    # keep the look direction as separate e, n, u arrays rather than stacking and transposing an (N,3) copy
     e, n, u = pm.ecef2enu(x, y, z, site[0], site[1], site[2])
-    v = np.array([e,n,u])
-    v = (v/np.linalg.norm(v, axis=0)).T
-    _,_,_,_,_,_,d1,d2,d3,_,_,_ = A.basevectors_apex(site[0], site[1], site[2]/1000.)
+    r = np.sqrt(e**2 + n**2 + u**2)
+    e = e/r
+    n = n/r
+    u = u/r
+
+    # normalized base vectors at the site only need to be computed once
+    d1, d2, d3, _, _, _ = site_basevectors(starttime.year, site[0], site[1], site[2]/1000.)
+    d1 = d1/np.linalg.norm(d1)
+    d2 = d2/np.linalg.norm(d2)
+    d3 = d3/np.linalg.norm(d3)
 
-    me = np.dot(v,d1/np.linalg.norm(d1))    # component along magnetic east
-    ms = np.dot(v,d2/np.linalg.norm(d2))    # compontent along magnetic south
-    md = np.dot(v,d3/np.linalg.norm(d3))    # component parallel to the magnetic field
+    me = e*d1[0] + n*d1[1] + u*d1[2]    # component along magnetic east
+    ms = e*d2[0] + n*d2[1] + u*d2[2]    # compontent along magnetic south
+    md = e*d3[0] + n*d3[1] + u*d3[2]    # component parallel to the magnetic field
 
     mz = np.arccos(md)*180./np.pi
     maz = np.arctan2(-me,ms)*180./np.pi
@@ -100,9 +85,16 @@ if any(i in outcomp for i in ['MAGAZ','MAGEL','MAGZ']):
 
 
 # save data to txt file
-outdata = np.array([output[k] for k in outcomp]).T
+# rows are written in blocks, each formatted with a single string operation, rather than building the full
+#   transposed output array and formatting it row by row with np.savetxt (the file contents are the same)
 header = ''.join([f'{t:^16}' for t in outcomp])
-np.savetxt(outfile, outdata, fmt='%15.5f',header=header)
+row_format = ' '.join(['%15.5f']*len(outcomp))+'\n'
+block_size = 65536
+with open(outfile, 'w') as f:
+    f.write('# '+header+'\n')
+    for i in range(0, len(unix_time_array), block_size):
+        block = np.column_stack([output[k][i:i+block_size] for k in outcomp])
+        f.write(row_format*len(block) % tuple(block.ravel()))
 
 # # For double checking output:
 # import matplotlib.pyplot as plt
@@ -1,9 +1,12 @@
 # ipp_utils.py
 # Utilities for calculating ionospheric pierce points
+# Requires numba (https://numba.pydata.org/)
 
 import numpy as np
 import datetime as dt
 import pymap3d as pm
+import functools
+from numba import njit, prange
 
 def projalt(site,az,el,proj_alt=300.):
 
@@ -16,12 +19,11 @@ def projalt(site,az,el,proj_alt=300.):
 
     earth = pm.Ellipsoid()
     a2 = (earth.semimajor_axis + proj_alt*1000.)**2
-    b2 = (earth.semimajor_axis + proj_alt*1000.)**2
     c2 = (earth.semiminor_axis + proj_alt*1000.)**2
 
-    A = vx**2/a2 + vy**2/b2 + vz**2/c2
-    B = x*vx/a2 + y*vy/b2 + z*vz/c2
-    C = x**2/a2 + y**2/b2 + z**2/c2 -1
+    A = (vx**2 + vy**2)/a2 + vz**2/c2
+    B = (x*vx + y*vy)/a2 + z*vz/c2
+    C = (x**2 + y**2)/a2 + z**2/c2 -1
 
     alpha = (np.sqrt(B**2-A*C)-B)/A
 
@@ -31,27 +33,74 @@ def projalt(site,az,el,proj_alt=300.):
 
 
 def calc_ipp(site, sat_ephem, height=300.):
-    lat0, lon0, alt0 = site
-    x, y, z = pm.geodetic2ecef(lat0, lon0, alt0)
 
-    vx = sat_ephem[0] - x
-    vy = sat_ephem[1] - y
-    vz = sat_ephem[2] - z
+    xipp, yipp, zipp = site_ipp_intersect(sat_ephem[0], sat_ephem[1], sat_ephem[2], site, height)
 
-    earth = pm.Ellipsoid()
-    a2 = (earth.semimajor_axis + height*1000.)**2
-    b2 = (earth.semimajor_axis + height*1000.)**2
-    c2 = (earth.semiminor_axis + height*1000.)**2
+    lat, lon, alt = pm.ecef2geodetic(xipp, yipp, zipp)
 
-    A = vx**2/a2 + vy**2/b2 + vz**2/c2
-    B = x*vx/a2 + y*vy/b2 + z*vz/c2
-    C = x**2/a2 + y**2/b2 + z**2/c2 -1
+    return lat, lon, alt/1000.
 
-    alpha = (np.sqrt(B**2-A*C)-B)/A
 
-    lat, lon, alt = pm.ecef2geodetic(x + alpha*vx, y + alpha*vy, z + alpha*vz)
+def ipp_intersect(xsat, ysat, zsat, xrec, yrec, zrec, a2, c2):
+    # Find the ECEF point where the line from a receiver to each satellite position crosses the ellipsoid
+    #   (x**2+y**2)/a2 + z**2/c2 = 1 (the ellipsoid with axes extended to the IPP height)
+    shape = np.shape(xsat)
+    xsat = np.ascontiguousarray(xsat, dtype=np.float64).ravel()
+    ysat = np.ascontiguousarray(ysat, dtype=np.float64).ravel()
+    zsat = np.ascontiguousarray(zsat, dtype=np.float64).ravel()
 
-    return lat, lon, alt/1000.
+    xipp, yipp, zipp = _ipp_intersect(xsat, ysat, zsat, float(xrec), float(yrec), float(zrec), float(a2), float(c2))
+
+    return xipp.reshape(shape), yipp.reshape(shape), zipp.reshape(shape)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _ipp_intersect(xsat, ysat, zsat, xrec, yrec, zrec, a2, c2):
+    # Solve the ray/ellipsoid quadratic for every satellite position in a single pass, so none of the
+    #   intermediate (vx, vy, vz, A, B, C, alpha) arrays are ever allocated
+    # The ellipsoid is symmetric about the z axis, so the x and y axes share a2
+    xipp = np.empty_like(xsat)
+    yipp = np.empty_like(ysat)
+    zipp = np.empty_like(zsat)
+
+    C = (xrec*xrec + yrec*yrec)/a2 + zrec*zrec/c2 - 1.
+
+    for i in prange(xsat.size):
+        vx = xsat[i] - xrec
+        vy = ysat[i] - yrec
+        vz = zsat[i] - zrec
+
+        A = (vx*vx + vy*vy)/a2 + vz*vz/c2
+        B = (xrec*vx + yrec*vy)/a2 + zrec*vz/c2
+
+        alpha = (np.sqrt(B*B-A*C)-B)/A
+
+        xipp[i] = xrec + alpha*vx
+        yipp[i] = yrec + alpha*vy
+        zipp[i] = zrec + alpha*vz
+
+    return xipp, yipp, zipp
+
+
+def site_ipp_intersect(xsat, ysat, zsat, site, height=300.):
+    # Same as ipp_intersect(), but for a receiver at geodetic site coordinates (lat, lon, alt) and an IPP
+    #   height in km
+    xrec, yrec, zrec, a2, c2 = _site_ipp_geometry(tuple(float(s) for s in site), float(height))
+    return ipp_intersect(xsat, ysat, zsat, xrec, yrec, zrec, a2, c2)
+
+
+@functools.lru_cache(maxsize=16)
+def _site_ipp_geometry(site, height):
+    # Receiver ECEF position and squared ellipsoid axes (once per site and height)
+    # Sites are typically fixed for an entire analysis, so this saves the geodetic2ecef conversion when
+    #   processing many PRNs/times
+    xrec, yrec, zrec = [float(r) for r in pm.geodetic2ecef(site[0], site[1], site[2])]
+
+    earth = pm.Ellipsoid()
+    a2 = (earth.semimajor_axis + height*1000.)**2
+    c2 = (earth.semiminor_axis + height*1000.)**2
+
+    return xrec, yrec, zrec, a2, c2
 
 def gaussiran_method(site, az, el, height=300.):
 
@@ -72,26 +121,27 @@ def gaussiran_method(site, az, el, height=300.):
 
 
 def parse_sp3(filename):
-    sat_ephem = {}
-    time = []
-
     with open(filename,'r') as sp3file:
         lines = sp3file.readlines()
-        num_sat = int(lines[2].split()[1])
-
-        for s in range(num_sat):
-            sat_ephem['{:02}'.format(s+1)] = []
-
-        for j in range(22,len(lines)-1,num_sat+1):
-
-            t = lines[j][2:-6]
-            time.append(dt.datetime.strptime(t, ' %Y %m %d %H %M %S.%f'))
-
-            for i in range(num_sat):
-                s = lines[j+i+1].split()
-                sat_ephem[s[0][2:]].append([float(s[1]),float(s[2]),float(s[3])])
-
-    for sat in sat_ephem:
-        sat_ephem[sat] = np.array(sat_ephem[sat]).T*1000.
-
-    return sat_ephem, np.array(time)
+    num_sat = int(lines[2].split()[1])
+
+    # After the header, each epoch is a time line followed by a position line for every satellite
+    # Parse all position lines with a single call to np.loadtxt instead of converting each value in python
+    records = lines[22:len(lines)-1]
+    num_epoch = len(range(0, len(records), num_sat+1))
+    records = records[:num_epoch*(num_sat+1)]
+    epoch_lines = records[::num_sat+1]
+    del records[::num_sat+1]
+
+    sat_list = [s.split()[0][2:] for s in records[:num_sat]]
+    position = np.loadtxt(records, usecols=(1,2,3), ndmin=2).reshape(num_epoch, num_sat, 3)
+    sat_ephem = {sat:position[:,i,:].T*1000. for i, sat in enumerate(sat_list)}
+
+    # convert epoch lines (year, month, day, hour, minute, second) to datetimes
+    t = np.loadtxt([e[1:] for e in epoch_lines], ndmin=2)
+    date = (t[:,0]-1970).astype('int64').astype('datetime64[Y]') + (t[:,1]-1).astype('int64').astype('timedelta64[M]')
+    date = date.astype('datetime64[D]') + (t[:,2]-1).astype('int64').astype('timedelta64[D]')
+    seconds = t[:,3]*3600. + t[:,4]*60. + t[:,5]
+    time = date.astype('datetime64[us]') + np.round(seconds*1.e6).astype('int64').astype('timedelta64[us]')
+
+    return sat_ephem, time.astype(dt.datetime)
@@ -10,8 +10,40 @@
 from ftplib import FTP
 import datetime as dt
 import numpy as np
+import functools
+import pathlib
+import pickle
+import time
+from cache_utils import atomic_write
 
+# The parsed PRN table is cached on disk and only re-downloaded once the cache is older than this
+prn_cache_file = pathlib.Path.home().joinpath('.cache', 'prn_mapping.pkl')
+prn_cache_max_age = 7*24*60*60     # seconds
+
+@functools.lru_cache(maxsize=1)
 def retrieve_prn_mapping_info():
+    # Return the PRN mapping dictionary, from the on-disk cache if it is recent enough
+    # The result is also memoized, so repeated calls in the same session are free
+
+    try:
+        if time.time() - prn_cache_file.stat().st_mtime < prn_cache_max_age:
+            with open(prn_cache_file, 'rb') as f:
+                return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    prn_mapping_dict = download_prn_mapping_info()
+
+    try:
+        with atomic_write(prn_cache_file) as f:
+            pickle.dump(prn_mapping_dict, f)
+    except OSError:
+        print('Could not write PRN mapping cache to {}'.format(prn_cache_file))
+
+    return prn_mapping_dict
+
+
+def download_prn_mapping_info():
     # Retrieve PRN table from AGI FPI site and convert it to a dictionary
     # ftp://ftp.agi.com/pub/Catalog/Almanacs/SEM/GPSData.txt
 
@@ -22,47 +54,44 @@ def retrieve_prn_mapping_info():
     ftp.retrlines('RETR pub/Catalog/Almanacs/SEM/GPSData.txt', callback=prn_table.append)
     ftp.quit()
 
-    # parse lines of table
+    # parse lines of table into a single structured array
     header_length = 22      # number of header lines
-    prn = np.empty((0,), dtype=int)
-    svn = np.empty((0,), dtype=int)
-    satnum = np.empty((0,), dtype=int)
-    starttime = np.empty((0,), dtype=dt.date)
-    endtime = np.empty((0,), dtype=dt.date)
-
+    rows = []
     for line in prn_table[header_length:]:
         ls = line.split()
         # skip empty lines
-        try:
-            prn = np.append(prn, int(ls[0]))
-        except IndexError:
+        if not ls:
             continue
-        svn = np.append(svn, int(ls[1]))
-        satnum = np.append(satnum, int(ls[2]))
-        starttime = np.append(starttime, dt.date.fromisoformat(ls[7]))
         # handle current satelite (no endtime given)
-        # this treatment assumes input will always be a time in the past
-        try:
-            endtime = np.append(endtime, dt.date.fromisoformat(ls[11]))
-        except IndexError:
-            endtime = np.append(endtime, dt.date.today())
+        # use an open-ended endtime rather than today so the table stays valid while it is cached
+        endtime = ls[11] if len(ls)>11 else dt.date.max.isoformat()
+        rows.append((ls[0], ls[1], ls[2], ls[7], endtime))
+
+    table = np.array(rows, dtype=[('PRN',int), ('SVN',int), ('NORADID',int), ('STARTTIME','datetime64[D]'), ('ENDTIME','datetime64[D]')])
 
     # organize into dictionary based on PRN
+    # sorting by PRN (then date) once and splitting at each new PRN replaces a full scan of the table for every PRN
+    table = np.sort(table, order=['PRN','STARTTIME'])
+    prn_list, first_row = np.unique(table['PRN'], return_index=True)
+
+    # PRNs that don't appear in the table have empty entries
+    prn_groups = {int(prn):prn_rows for prn, prn_rows in zip(prn_list, np.split(table, first_row[1:]))}
     prn_mapping_dict = {}
-    for i in range(1,32):
-        idx = np.argwhere(prn==i).flatten()
-        prn_mapping_dict[i] = {'SVN':svn[idx], 'NORADID':np.array(satnum[idx]), 'STARTTIME':np.array(starttime[idx]), 'ENDTIME':np.array(endtime[idx])}
+    for prn in sorted(set(range(1,33)) | set(prn_groups)):
+        prn_rows = prn_groups.get(prn, table[:0])
+        prn_mapping_dict[prn] = {'SVN':prn_rows['SVN'], 'NORADID':prn_rows['NORADID'], 'STARTTIME':prn_rows['STARTTIME'], 'ENDTIME':prn_rows['ENDTIME']}
 
     return prn_mapping_dict
 
 
 def find_date_index(startdates, enddates, targdate):
-    # find the index where the target date is between the start and end dates
+    # find the index where the target date is between the start and end dates ([start, end) intervals)
     # raises an error if the date does not correspond to a range in the PRN table
+    # startdates must be sorted, which they are in the PRN mapping dictionary, so this can use a binary search
 
-    try:
-        tidx = np.argwhere((targdate>=startdates) & (targdate<enddates)).flatten()[0]
-    except IndexError:
+    targdate64 = np.datetime64(targdate, 'D')
+    tidx = np.searchsorted(startdates, targdate64, side='right') - 1
+    if tidx < 0 or targdate64 >= enddates[tidx]:
         raise ValueError('The specified PRN was not used on {}!'.format(targdate.isoformat()))
 
     return tidx
@@ -2,7 +2,7 @@
 
 # Propigates satellite position at a particular time given a Two Line Element.
 # Based primarially off of Vallado 2006
-# Requires the sgp4 package (https://pypi.org/project/sgp4/)
+# Requires the sgp4 package (https://pypi.org/project/sgp4/) and numba (https://numba.pydata.org/)
 # References:
 #   Vallado, D. A., Crawford, P., Hujsak, R., and Kelso, T. S. (2006). "Revisiting Spacetrack Report #3",
 #       presented at the AIAA/AAS Astrodynamics Specialist Converence, Keystone, CO, 2006 August 21-24.
@@ -11,15 +11,46 @@
 
 import numpy as np
 import datetime as dt
-import pymap3d as pm
+import sys
+import math
+import time
+import pathlib
 from spacetrack import SpaceTrackClient
-from sgp4.earth_gravity import wgs72
-from sgp4.io import twoline2rv
-from sgp4.ext import jday
+from sgp4.api import Satrec, SatrecArray, accelerated
+from numba import njit, prange
+from cache_utils import save_npz_cache, cache_load_errors
+
+# sgp4.api falls back to the pure python SGP4 model if its C++ extension is not available, which propagates each
+#   time in a python loop rather than the whole time array in compiled code
+if not accelerated:
+    print('sgp4 C++ extension not available - TLE propagation will be very slow.  Install sgp4 from a binary wheel (pip install sgp4).')
 
 # import SpaceTrack username and password
 from space_track_credentials import *
 
+# Constants for the TEME->PEF conversion
+_J2000 = 2451545.0          # Julian date of the J2000 epoch
+_CEN = 36525.               # days per Julian century
+_RAD_PER_SEC = 2*np.pi/86400.   # sidereal angle per second of GMST
+# GMST polynomial coefficients (units of s) - Vallado et al., 2006, eqn. 2
+_A0 = 67310.54841
+_A1 = 876600*60*60+8640184.812866
+_A2 = 0.093104
+_A3 = -6.2e-6
+# WGS84 ellipsoid semimajor and semiminor axes (m)
+_WGS84_A = 6378137.
+_WGS84_B = 6356752.31424518
+# Earth rotation rate (rad/s)
+_EARTH_ROTATION = 7.292115e-5
+# The geodetic conversion kernels use the numpy error model (division by zero gives inf/nan rather than raising) and
+#   all the fastmath optimizations except the ones that assume there are no NaN or infinite values, so a NaN
+#   position (SGP4 error state) or a point on the polar axis gives NaN/+-90 deg instead of failing the entire array
+_GEODETIC_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# TLEHandler libraries are cached on disk and only re-downloaded once the cache is older than this
+tle_library_dir = pathlib.Path.home().joinpath('.cache', 'satconj')
+tle_library_max_age = 24*60*60     # seconds
+
 class TLEHandler(object):
     def __init__(self, sid):
 
@@ -30,38 +61,100 @@ class TLEHandler(object):
         # The space-track.org API limits the number of calls you can make, so it's better to retreive the
         #   entire library for one satellite and save it as a class attribute than try to collect indivitual
         #   TLEs as needed.
-        st = SpaceTrackClient(identity=ST_USERNAME, password=ST_PASSWORD)
-        output = st.tle(norad_cat_id=sid, orderby='epoch asc', format='tle')
-
-        # parse output into list of distinct TLEs
-        split = output.splitlines()
-        self.TLE_list = [[split[2*i],split[2*i+1]] for i in range(len(split)//2)]
-
-        # extract epoch from each TLE
-        self.TLE_epoch = [dt.datetime.strptime(tle[0][18:23],'%y%j')+dt.timedelta(days=float(tle[0][23:32])) for tle in self.TLE_list]
+        # The library (with the parsed epochs) is kept on disk for a day, so repeated runs don't have to retrieve the
+        #   entire history from space-track.org and parse it again
+        cache_file = tle_library_dir.joinpath('{}.npz'.format(sid))
+        try:
+            if time.time() - cache_file.stat().st_mtime < tle_library_max_age:
+                with np.load(cache_file) as cache:
+                    line1, line2, self.TLE_epoch = cache['line1'], cache['line2'], cache['epoch']
+                self.TLE_list = [[l1, l2] for l1, l2 in zip(line1.astype('U69').tolist(), line2.astype('U69').tolist())]
+            else:
+                self.TLE_list = None
+        except cache_load_errors:
+            self.TLE_list = None
+
+        if self.TLE_list is None:
+            st = SpaceTrackClient(identity=ST_USERNAME, password=ST_PASSWORD)
+            output = st.tle(norad_cat_id=sid, orderby='epoch asc', format='tle')
+
+            # parse output into list of distinct TLEs
+            split = output.splitlines()
+            self.TLE_list = [[split[2*i],split[2*i+1]] for i in range(len(split)//2)]
+
+            # extract epoch from each TLE
+            self.TLE_epoch = tle_epoch(self.TLE_list)
+
+            try:
+                save_npz_cache(cache_file, compressed=True, line1=np.array([tle[0] for tle in self.TLE_list], dtype='S69'),
+                               line2=np.array([tle[1] for tle in self.TLE_list], dtype='S69'), epoch=self.TLE_epoch)
+            except OSError:
+                print('Could not write TLE library cache file {}'.format(cache_file))
+
+        # the midpoints between epochs are all that is needed to find the closest TLE to a time, so they are only
+        #   calculated once here rather than for every call to sat_position
+        self.TLE_epoch_midpoints = epoch_midpoints(self.TLE_epoch)
+
+        # initialize the SGP4 model for each TLE once, rather than every time sat_position is called
+        self.satrecs = [Satrec.twoline2rv(tle[0], tle[1]) for tle in self.TLE_list]
+
+        # upper bound on the speed (m/s) of the satellite in the Earth-fixed frame for each TLE - the perigee speed of
+        #   the orbit plus the speed of the frame rotation at apogee, with 10% added for perturbations
+        a = np.array([s.a*s.radiusearthkm*1000. for s in self.satrecs])
+        e = np.array([s.ecco for s in self.satrecs])
+        mu = np.array([s.mu*1.e9 for s in self.satrecs])
+        self.TLE_max_speed = 1.1*(np.sqrt(mu/a*(1.+e)/(1.-e)) + _EARTH_ROTATION*a*(1.+e))
 
     def sat_position(self, time_array):
 
         # Find index of epoch closest to each time in the time array
-        unix_time_array = np.array(time_array).astype('datetime64')
-        unix_TLE_epoch = np.array(self.TLE_epoch).astype('datetime64')
-        closest_epoch_idx = np.array([np.argmin(np.abs(ut-unix_TLE_epoch)) for ut in unix_time_array])
-
-        sat_position = np.empty((3,0))
-
-        for i in np.unique(closest_epoch_idx):
-            subset_times = time_array[closest_epoch_idx==i]
-
-            # calcualte satellite position using functions from TLE propgation script
-            X, Y, Z = propagate_tle(subset_times,self.TLE_list[i])
-            sat_position = np.append(sat_position, np.array([X, Y, Z]), axis=1)
-
-        return sat_position
-
-
-def propagate_tle(time0, TLE):
+        # TLEs are retrieved in epoch order, so this is a binary search rather than an argmin over every epoch
+        #   for each time
+        closest_epoch_idx = closest_midpoint_index(time_array, self.TLE_epoch_midpoints)
+
+        # calcualte satellite position for all times at once - the Julian dates and the TEME->PEF rotation are
+        #   evaluated over the entire time array instead of separately for the times closest to each TLE
+        # this is already the (3,N) array of X, Y, Z, so there is no need to stack a copy
+        return propagate_satrec_set(time_array, self.satrecs, closest_epoch_idx)
+
+    @classmethod
+    def sat_position_many(cls, handlers, time_array):
+        # Calculate the positions of several satellites (a list of TLEHandlers) at the same times
+        # Returns a (K,3,N) array for K handlers and N times, where [k] is handlers[k].sat_position(time_array)
+        # All satellites are propagated together with sgp4.api.SatrecArray and rotated to PEF in one pass,
+        #   rather than propagating and rotating each satellite separately
+
+        jd, fr = jday_array(time_array)
+        if not len(handlers) or not len(jd):
+            return np.empty((len(handlers),3,len(jd)))
+        tle_idx = np.array([closest_midpoint_index(time_array, h.TLE_epoch_midpoints) for h in handlers]).reshape(len(handlers),-1)
+
+        # split the time array wherever any satellite changes TLE, so that within each segment every satellite
+        #   uses a single TLE and the whole constellation can be propagated with one SatrecArray call
+        change = np.flatnonzero(np.any(tle_idx[:,1:]!=tle_idx[:,:-1], axis=0))+1
+        starts = np.append(0, change)
+        stops = np.append(change, len(jd))
+
+        position_TEME = np.empty((len(handlers),len(jd),3))
+        for start, stop in zip(starts, stops):
+            sats = SatrecArray([h.satrecs[i] for h, i in zip(handlers, tle_idx[:,start])])
+            _, position_TEME[:,start:stop], _ = sats.sgp4(jd[start:stop], fr[start:stop])
+
+        # rotate all satellites at once - the GMST rotation for each time is shared by every satellite
+        position_PEF = np.empty((len(handlers),3,len(jd)))
+        _teme_to_pef_many(position_TEME, jd, fr, position_PEF)
+
+        return position_PEF
+
+
+def propagate_tle(time0, TLE, frame='pef'):
     # time0 is an array of datetime objects that the satellite position is to be calculated at
     # TLE is a list consisting of the first and second lines of the TLE as strings ([TLE line 1, TLE line 2])
+    # frame selects the coordinates returned:
+    #   'pef' - X, Y, Z (m) in PEF coordinates from the GMST rotation below (default)
+    #   'teme' - X, Y, Z (m) in the TEME coordinates SGP4 produces, with no rotation
+    #   'geodetic' - geodetic latitude, longitude (degrees) and altitude (m) of the PEF position, for callers
+    #       that only need geodetic coordinates (the rotation and conversion are done in one pass)
 
     # Note: This function returns satellite position in Pseudo Earth-Fixed (PEF) coordinates, which are
     #   assumed to be approximately equal to Earth-Centered, Earth-Fixed (ECEF) coordinates.  This does NOT
@@ -69,55 +162,284 @@ def propagate_tle(time0, TLE):
     #   please refer to Vallado et al., 2006 Appendix C or Panigrahi and Gaurav, 2015
     #   (https://mycoordinates.org/tracking-satellite-footprints-on-earth%E2%80%99s-surface/)
 
-    X = []
-    Y = []
-    Z = []
+    # The position for every time is calculated in a single call to the C SGP4 kernel (sgp4_array) instead of
+    #   propagating one time at a time in python
+
+    # Julian dates of all times, split into whole and fractional days to preserve precision
+    jd, fr = jday_array(time0)
 
     # initialize tle object
-    tle = twoline2rv(TLE[0],TLE[1],wgs72)
+    tle = Satrec.twoline2rv(TLE[0],TLE[1])
+
+    # calculate satellite position/velocity in True Equator, Mean Equinox [TEME] (units of km and km/s)
+    _, position_TEME, _ = tle.sgp4_array(jd, fr)
+
+    if frame == 'teme':
+        return position_TEME.T*1000.
+    elif frame == 'geodetic':
+        return teme2geodetic(position_TEME, jd, fr)
+    elif frame == 'pef':
+        # convert to Pseudo Earth Fixed [PEF] (units of m)
+        return teme2pef(position_TEME, jd, fr)
+
+    raise ValueError('Unknown frame {}!  Must be pef, teme or geodetic.'.format(frame))
 
-    for t in time0:
 
-        # calculate satellite position/velocity in True Equator, Mean Equinox [TEME] (units of km and km/s)
-        position, velocity = tle.propagate(t.year,month=t.month,day=t.day,hour=t.hour,minute=t.minute,second=t.second)
-        position_TEME = np.array(position)
 
+def tle_epoch(TLE_list):
+    # Return the epoch of each TLE in TLE_list as a datetime64[us] array
+    # The epoch is in columns 19-32 of TLE line 1 as a two digit year (57-99 are 1900s, 00-56 are 2000s), a day
+    #   of year, and fractional day.  This is converted with numpy arithmetic rather than strptime for each TLE.
+    # Line 1 of every TLE is collected into one fixed width byte string array, which is then viewed as separate
+    #   year, day of year and fractional day fields so each is converted with a single astype (byte strings are
+    #   converted to numbers several times faster than unicode strings, and no per-TLE slicing is needed)
+    field = np.array([tle[0] for tle in TLE_list], dtype='S69').view([('id','S18'), ('yy','S2'), ('doy','S3'), ('frac','S9'), ('elements','S37')])
+    yy = field['yy'].astype('int64')
+    doy = field['doy'].astype('int64')
+    frac = field['frac'].astype('float64')
 
-        # convert to Pseudo Earth Fixed [PEF]
+    year = np.where(yy<57, 2000, 1900) + yy
+    epoch = (year-1970).astype('datetime64[Y]').astype('datetime64[us]') + (doy-1).astype('timedelta64[D]')
+    return epoch + np.round(frac*86400.e6).astype('int64').astype('timedelta64[us]')
 
-        # compute Julian centeries of UT1 - discussed in Vallado et al., 2006, sec. II.E
-        JD = jday(t.year,t.month,t.day,t.hour,t.minute,t.second)
-        T_UT1 = (JD - 2451545.0)/36525.
 
-        # compute Greenwich Mean Sidereal Time (units of s) - Vallado et al., 2006, eqn. 2
-        GMST = (67310.54841+(876600*60*60+8640184.812866)*T_UT1+0.093104*T_UT1**2-6.2e-6*T_UT1**3)
-        # convert GMST to angle (units of rad)
-        GMST = GMST*2*np.pi/86400. % (2*np.pi)
-        # form rotational matrix
-        Rot = np.array([[np.cos(GMST),np.sin(GMST),0.],[-np.sin(GMST),np.cos(GMST),0.],[0.,0.,1.]])
-        # apply rotational matrix to TEME position to get PEF position (units of km) - Valladeo et al., 2006, eqn. 1
-        position_PEF = np.dot(Rot,position_TEME)
+def closest_epoch_index(time0, epoch):
+    # Return the index of the epoch closest to each time in time0
+    # epoch must be sorted (TLEs are retrieved in epoch order), so this is a binary search against the midpoints
+    #   between consecutive epochs rather than comparing every time to every epoch - comparing all of them at once
+    #   causes HUGE memory problems when arrays are large (when trying to find conjunctions for years at a time)
+    return closest_midpoint_index(time0, epoch_midpoints(epoch))
 
-        # add position to coordinate arrays
-        X.append(position_PEF[0])
-        Y.append(position_PEF[1])
-        Z.append(position_PEF[2])
 
-    return np.array(X)*1000., np.array(Y)*1000., np.array(Z)*1000.
+def epoch_midpoints(epoch):
+    # Times halfway between consecutive (sorted) epochs, which bound the times each epoch is closest to
+    epoch = np.asarray(epoch, dtype='datetime64[us]')
+    return epoch[:-1] + (epoch[1:]-epoch[:-1])/2
 
 
+def closest_midpoint_index(time0, midpoints):
+    # Same as closest_epoch_index(), with the epoch midpoints already calculated by epoch_midpoints()
+    # Ties go to the earlier epoch
+    return np.searchsorted(midpoints, np.asarray(time0, dtype='datetime64[us]'), side='left')
+
+
+def propagate_tle_set(time0, TLE_list, tle_idx):
+    # time0 is an array of datetime objects that the satellite position is to be calculated at
+    # TLE_list is a list of TLEs, each a list of the first and second lines of the TLE as strings
+    # tle_idx is an array the same length as time0 giving the index of the TLE in TLE_list to use for each time
+    #   (usually the TLE with the epoch closest to that time)
+
+    # Positions are returned in the same approximate ECEF (PEF) coordinates as propagate_tle().  All times for
+    #   a particular TLE are propagated in a single call to the C SGP4 kernel and written directly into the
+    #   output array, rather than looping over each time in python and concatenating the results.
+
+    satrecs = {i:Satrec.twoline2rv(TLE_list[i][0], TLE_list[i][1]) for i in np.unique(tle_idx)}
+
+    return propagate_satrec_set(time0, satrecs, tle_idx)
+
+
+def propagate_satrec_set(time0, satrecs, tle_idx):
+    # Same as propagate_tle_set(), but with satrecs a list (or dictionary) of already initialized
+    #   sgp4.api.Satrec objects instead of TLE strings, so TLEs don't have to be re-parsed for every call
+    jd, fr = jday_array(time0)
+    order, groups = tle_groups(tle_idx)
+
+    # propagate contiguous runs of times sorted by TLE, then put the positions back in the original order
+    jd_sorted = jd[order]
+    fr_sorted = fr[order]
+    position_TEME = np.empty((len(jd),3))
+    for i, s in groups:
+        _, position_TEME[s], _ = satrecs[i].sgp4_array(jd_sorted[s], fr_sorted[s])
+    if not isinstance(order, slice):
+        position_TEME[order] = position_TEME.copy()
+
+    return teme2pef(position_TEME, jd, fr)
+
+
+def tle_groups(tle_idx):
+    # Partition times by the TLE used for them
+    # Returns the (stable) permutation that sorts tle_idx and a list of (TLE index, slice) pairs giving the run
+    #   of sorted times for each TLE.  This takes one sort, rather than a full scan of tle_idx to form a
+    #   boolean mask for every TLE.
+    # For time-ordered arrays (the usual case) tle_idx is already sorted, and the permutation is returned as
+    #   slice(None) so indexing with it gives views rather than copies
+    tle_idx = np.asarray(tle_idx)
+    if np.all(tle_idx[1:] >= tle_idx[:-1]):
+        order = slice(None)
+    else:
+        order = np.argsort(tle_idx, kind='stable')
+    tle_list_idx, starts = np.unique(tle_idx[order], return_index=True)
+    stops = np.append(starts[1:], len(tle_idx))
+    return order, [(i, slice(start, stop)) for i, start, stop in zip(tle_list_idx, starts, stops)]
+
+
+def jday_array(time0):
+    # Julian date of an array of datetime objects (or datetime64 array), split into whole and fractional days
+    #   like sgp4.api.jday
+    # The split is done in integer microseconds, so the fractional day is exact to the resolution of the input
+    #   rather than being the difference of two large floating point numbers
+    unix_time = np.asarray(time0, dtype='datetime64[us]').astype('int64')
+    days, us = np.divmod(unix_time, 86400000000)
+    return days + 2440587.5, us/86400.e6
+
+
+def teme2pef(position_TEME, jd, fr):
+    # Rotate an (N,3) array of TEME positions (km) at Julian dates jd+fr to PEF positions (m)
+    # PEF positions are returned as a single contiguous (3,N) array, so each of X, Y, Z is a contiguous row
+    #   (X, Y, Z = teme2pef(...) unpacks the rows without copying)
+
+    if len(jd) == 1:
+        # for a single time (e.g. stepping along an orbit one point at a time) the rotation is done with python
+        #   floats - launching the parallel kernel costs more than the calculation itself
+        x, y, z = np.ravel(position_TEME).tolist()
+        T_UT1 = ((jd[0] - _J2000) + fr[0])/_CEN
+        GMST = math.fmod(((_A3*T_UT1+_A2)*T_UT1+_A1)*T_UT1+_A0, 86400.)*_RAD_PER_SEC
+        cosGMST = math.cos(GMST)
+        sinGMST = math.sin(GMST)
+        return np.array([[(cosGMST*x + sinGMST*y)*1000.], [(-sinGMST*x + cosGMST*y)*1000.], [z*1000.]])
+
+    position_PEF = np.empty((3,len(jd)))
+    _teme_to_pef(np.ascontiguousarray(position_TEME, dtype=np.float64), np.asarray(jd, dtype=np.float64), np.asarray(fr, dtype=np.float64), position_PEF)
+
+    return position_PEF
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _teme_to_pef(position_TEME, jd, fr, out):
+    # The GMST polynomial, trig, and rotation are evaluated for each time in a single parallel loop, so none of
+    #   the intermediate (T_UT1, GMST, cos, sin) arrays are ever allocated
+    for i in prange(jd.size):
+        out[0,i], out[1,i], out[2,i] = _pef_position(position_TEME[i,0], position_TEME[i,1], position_TEME[i,2], jd[i], fr[i])
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _teme_to_pef_many(position_TEME, jd, fr, out):
+    # Rotate a (K,N,3) array of TEME positions (km) of K satellites at the same N Julian dates jd+fr to a (K,3,N)
+    #   array of PEF positions (m)
+    # The rotation only depends on time, so GMST and its sin/cos are evaluated once per time for all satellites
+    for i in prange(jd.size):
+        GMST = _gmst(jd[i], fr[i])
+        cosGMST = math.cos(GMST)
+        sinGMST = math.sin(GMST)
+        for k in range(position_TEME.shape[0]):
+            x = position_TEME[k,i,0]
+            y = position_TEME[k,i,1]
+            out[k,0,i] = (cosGMST*x + sinGMST*y)*1000.
+            out[k,1,i] = (-sinGMST*x + cosGMST*y)*1000.
+            out[k,2,i] = position_TEME[k,i,2]*1000.
+
+
+@njit(fastmath=True, cache=True)
+def _pef_position(x, y, z, jd, fr):
+    # Rotate a single TEME position (km) at Julian date jd+fr to PEF (m)
+    GMST = _gmst(jd, fr)
+
+    # apply rotation about the z axis to TEME position to get PEF position - Valladeo et al., 2006, eqn. 1
+    # cos and sin of the same angle next to each other are combined into a single sincos call by LLVM
+    cosGMST = math.cos(GMST)
+    sinGMST = math.sin(GMST)
+    return (cosGMST*x + sinGMST*y)*1000., (-sinGMST*x + cosGMST*y)*1000., z*1000.
+
+
+@njit(fastmath=True, cache=True)
+def _gmst(jd, fr):
+    # Greenwich Mean Sidereal Time angle (rad) at Julian date jd+fr
+
+    # compute Julian centeries of UT1 - discussed in Vallado et al., 2006, sec. II.E
+    T_UT1 = ((jd - _J2000) + fr)/_CEN
+
+    # compute Greenwich Mean Sidereal Time (units of s) - Vallado et al., 2006, eqn. 2
+    # the polynomial is evaluated in Horner form
+    GMST = ((_A3*T_UT1+_A2)*T_UT1+_A1)*T_UT1+_A0
+    # convert GMST to angle (units of rad)
+    # reduce to one day of seconds first, so the angle is formed from a bounded value rather than one of
+    #   order 1e8-1e9 s (fmod keeps the sign, so pre-J2000 angles are negative, which is the same rotation)
+    return np.fmod(GMST, 86400.)*_RAD_PER_SEC
+
+
+def ecef2geodetic(x, y, z):
+    # Convert ECEF coordinates (m) to geodetic latitude, longitude (degrees) and altitude (m) on the WGS84 ellipsoid
+    # This uses the closed-form solution of Zhu (1994), so unlike pymap3d.ecef2geodetic there is no iteration
+    #   and every point is converted in a single pass of a parallel numba kernel
+    shape = np.shape(x)
+    x = np.ascontiguousarray(x, dtype=np.float64).ravel()
+    y = np.ascontiguousarray(y, dtype=np.float64).ravel()
+    z = np.ascontiguousarray(z, dtype=np.float64).ravel()
+
+    geodetic = np.empty((3,x.size))
+    _ecef_to_geodetic(x, y, z, geodetic)
+
+    return geodetic[0].reshape(shape), geodetic[1].reshape(shape), geodetic[2].reshape(shape)
+
+
+def teme2geodetic(position_TEME, jd, fr):
+    # Convert an (N,3) array of TEME positions (km) at Julian dates jd+fr directly to geodetic latitude, longitude
+    #   (degrees) and altitude (m), returned as a (3,N) array
+    # This is the same as ecef2geodetic(*teme2pef(position_TEME, jd, fr)), but the rotation and geodetic
+    #   conversion are fused into one kernel so the PEF positions are never written out
+    geodetic = np.empty((3,len(jd)))
+    _teme_to_geodetic(np.ascontiguousarray(position_TEME, dtype=np.float64), np.asarray(jd, dtype=np.float64), np.asarray(fr, dtype=np.float64), geodetic)
+
+    return geodetic
+
+
+@njit(parallel=True, fastmath=_GEODETIC_FASTMATH, error_model='numpy', cache=True)
+def _ecef_to_geodetic(x, y, z, out):
+    for i in prange(x.size):
+        out[0,i], out[1,i], out[2,i] = _zhu_geodetic(x[i], y[i], z[i])
+
+
+@njit(parallel=True, fastmath=_GEODETIC_FASTMATH, error_model='numpy', cache=True)
+def _teme_to_geodetic(position_TEME, jd, fr, out):
+    for i in prange(jd.size):
+        x, y, z = _pef_position(position_TEME[i,0], position_TEME[i,1], position_TEME[i,2], jd[i], fr[i])
+        out[0,i], out[1,i], out[2,i] = _zhu_geodetic(x, y, z)
+
+
+@njit(fastmath=_GEODETIC_FASTMATH, error_model='numpy', cache=True)
+def _zhu_geodetic(x, y, z):
+    # Zhu (1994) closed-form conversion of a single ECEF point (m) to geodetic latitude, longitude (degrees)
+    #   and altitude (m) on the WGS84 ellipsoid
+    a = _WGS84_A
+    b = _WGS84_B
+    e2 = 1. - b**2/a**2         # first eccentricity squared
+    ep2 = a**2/b**2 - 1.        # second eccentricity squared
+
+    p = math.sqrt(x**2 + y**2)
+    F = 54.*b**2*z**2
+    G = p**2 + (1.-e2)*z**2 - e2*(a**2-b**2)
+    c = e2**2*F*p**2/G**3
+    s = np.cbrt(1. + c + math.sqrt(c**2 + 2.*c))
+    k = s + 1. + 1./s
+    P = F/(3.*k**2*G**2)
+    Q = math.sqrt(1. + 2.*e2**2*P)
+    # the terms under the square root cancel as the point approaches the polar axis (p -> 0), where rounding
+    #   can leave them slightly negative - clamping at zero gives the exact limit (lat = +-90, alt = |z| - b)
+    r0 = -P*e2*p/(1.+Q) + math.sqrt(max(0.5*a**2*(1.+1./Q) - P*(1.-e2)*z**2/(Q*(1.+Q)) - 0.5*P*p**2, 0.))
+    U = math.sqrt((p - e2*r0)**2 + z**2)
+    V = math.sqrt((p - e2*r0)**2 + (1.-e2)*z**2)
+    z0 = b**2*z/(a*V)
+
+    lat = math.atan2(z + ep2*z0, p)*180./math.pi
+    lon = math.atan2(y, x)*180./math.pi
+    alt = U*(1. - b**2/(a*V))
+
+    return lat, lon, alt
+
 
 def main():
     TLE = ['1     1U          18350.30892361  .00001123  00000-0  66525-4 0   109','2     1  85.0373 178.2871 0002550 225.5672 175.5175 15.21584957    13']
     times = np.array([dt.datetime(2018,12,17,0,0,0)+dt.timedelta(hours=h) for h in range(24)])
 
-    X, Y, Z = propagate_tle(times,TLE)
-    print(X, Y, Z)
-    gdlat, gdlon, gdalt = pm.ecef2geodetic(X,Y,Z)
+    gdlat, gdlon, gdalt = propagate_tle(times,TLE,frame='geodetic')
 
-    print('{:^20}{:^10}{:^10}{:^10}'.format('Time','GLAT','GLON','GALT'))
-    for t, lat, lon, alt in zip(times,gdlat,gdlon,gdalt):
-        print('{}{:10.2f}{:10.2f}{:10.2f}'.format(t, lat, lon, alt))
+    # write the table with a single savetxt call rather than formatting and printing each row
+    table = np.empty(len(times), dtype=[('Time','U19'), ('GLAT',float), ('GLON',float), ('GALT',float)])
+    table['Time'] = np.char.replace(np.datetime_as_string(times.astype('datetime64[s]')), 'T', ' ')
+    table['GLAT'] = gdlat
+    table['GLON'] = gdlon
+    table['GALT'] = gdalt
+    np.savetxt(sys.stdout, table, fmt='%s%10.2f%10.2f%10.2f', header='{:^20}{:^10}{:^10}{:^10}'.format('Time','GLAT','GLON','GALT'), comments='')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+# propagate_tle_batch.py
+# Batch TLE propagation with dSGP4 (https://github.com/esa/dSGP4), a PyTorch implementation of SGP4.
+# The SGP4 equations are evaluated as tensor operations over all times for a TLE at once, which is
+#   useful for very long time arrays and can run on a GPU through torch.
+# This is a drop-in alternative to propagate_tle.propagate_tle_set().
+# Requires the dsgp4 package (https://pypi.org/project/dsgp4/) and torch
+
+import numpy as np
+import torch
+import dsgp4
+from propagate_tle import jday_array, tle_groups, teme2pef
+
+
+def propagate_tle_batch(time0, TLE_list, tle_idx):
+    # time0 is an array of datetime objects that the satellite position is to be calculated at
+    # TLE_list is a list of TLEs, each a list of the first and second lines of the TLE as strings
+    # tle_idx is an array the same length as time0 giving the index of the TLE in TLE_list to use for each time
+    # Returns ECEF (PEF) positions in meters, the same as propagate_tle_set()
+
+    jd, fr = jday_array(time0)
+    order, groups = tle_groups(tle_idx)
+    jd_sorted = jd[order]
+    fr_sorted = fr[order]
+    position_TEME = np.empty((len(jd),3))
+
+    for i, s in groups:
+        tle = dsgp4.tle.TLE(list(TLE_list[i]))
+        dsgp4.initialize_tle(tle, gravity_constant_name='wgs-72')
+
+        # dSGP4 propagates in minutes since the TLE epoch
+        epoch_jd = float(tle._jdsatepoch)
+        epoch_fr = float(tle._jdsatepochF)
+        tsince = torch.tensor(((jd_sorted[s]-epoch_jd) + (fr_sorted[s]-epoch_fr))*1440.)
+        state = dsgp4.propagate(tle, tsince)
+        # only the position half of the state is copied off the device - velocity is never used
+        position_TEME[s] = state.detach().reshape(-1,2,3)[:,0,:].cpu().numpy()
+
+    # put the positions back in the original time order
+    if not isinstance(order, slice):
+        position_TEME[order] = position_TEME.copy()
+
+    return teme2pef(position_TEME, jd, fr)
@@ -5,6 +5,7 @@
 #   - apexpy (https://apexpy.readthedocs.io/en/latest/readme.html)
 #   - pymap3d (https://geospace-code.github.io/pymap3d/)
 #   - spacetrack (https://pythonhosted.org/spacetrack/)
+#   - numba (https://numba.pydata.org/)
 #   - propagate_tle.py
 # Note: This can take a very long time to calculate tight conjunctions over many years of data
 # This is an excellent site for validation: https://swarm-aurora.com/satelliteFinder/
@@ -13,21 +14,25 @@
 import datetime as dt
 import numpy as np
 import pymap3d as pm
+from numba import njit, prange
 try:
-    from apexpy import Apex
+    from apex_utils import geo2apex, site_apex_zenith
 except:
     print('Could not import apexpy - cannot calculate magnetic conjuntions.')
-from propagate_tle import TLEHandler
+from propagate_tle import TLEHandler, ecef2geodetic, closest_midpoint_index
 
 
 class SatConj(object):
 
-    def __init__(self, site_lat, site_lon, site_alt, sat_id, deltime=60., conjtype='zenith', tolerance=25., coords='geo'):
+    def __init__(self, site_lat, site_lon, site_alt, sat_id, deltime=60., conjtype='zenith', tolerance=25., coords='geo', coarse_deltime=None):
     # deltime = time step between calculations of the satellite position
     # conjtype = method to use for identifying conjunctions, either 'zenith' to find conjunctions within a certain angle of
     #   zenith or 'latlon' to find conjunctions within a certain lat/lon box of the site
     # tolerance = tolerance for conjunctions (angle in degrees for 'zenith' or 2-element list of dlat/dlon for 'latlon')
     # coords = whether to perform calculation in geodetic ('geo') or apex magnetic ('mag') coordinats
+    # coarse_deltime = time step for a first, coarse search for 'zenith' conjunctions (see coarse_search()) - by default
+    #   20 deltime steps, shortened so the satellite can't move more than coarse_max_margin in one coarse step.  Set to
+    #   0 to always check every deltime step
     #
     # The selections for deltime & tolerance can strongly impact the results.  The smaller deltime is, the finner
     #   the satellite position calculations will be, which reduces the change of "skipping over" a potential conjuction,
@@ -43,6 +48,13 @@ class SatConj(object):
         self.site_coordinates(site_lat, site_lon, site_alt)
         self.tle = TLEHandler(sat_id)
 
+        # Each coarse interval is kept if the satellite is within its maximum speed x the interval length of the
+        #   conjunction cone, so long intervals keep almost everything - the number of positions calculated is close to
+        #   the minimum for 10-20 deltime steps, as long as that margin stays under a few thousand km
+        if coarse_deltime is None:
+            coarse_deltime = min(20.*deltime, self.coarse_max_margin/np.max(self.tle.TLE_max_speed))
+        self.coarse_deltime = coarse_deltime
+
 
     def site_coordinates(self, site_lat, site_lon, site_alt):
         # find some basic site paramters
@@ -54,66 +66,234 @@ class SatConj(object):
         self.site_zenith = np.array(pm.enu2uvw(0., 0., 1., site_lat, site_lon))
 
 
-    def conjunctions(self, starttime, endtime):
+    # long periods are searched in chunks of this many days (see iter_conjunctions())
+    chunk_days = 30.
+
+    # largest distance (m) the satellite can move in one step of the default coarse search (see coarse_search())
+    coarse_max_margin = 3000.e3
+
+    def conjunctions(self, starttime, endtime, positions=True):
+        # find all passes of the satellite within tolerance of the site between starttime and endtime
+        # positions = whether to include the satellite position for each pass - if only pass times are needed, set this
+        #   to False so the position arrays for each pass aren't assembled
+        return list(self.iter_conjunctions(starttime, endtime, positions=positions))
+
+
+    def iter_conjunctions(self, starttime, endtime, positions=True):
+        # generator version of conjunctions() that yields each pass as it is found
+        # The period is searched in chunks of chunk_days, so the time and position arrays (and memory use) don't grow
+        #   with the length of the period.  A pass that runs over the end of a chunk is joined with its continuation at
+        #   the start of the next chunk, so the passes are the same as searching the whole period at once.
+        #
         # form array of times to find the satellite location
         # deltime selection is important - large values may miss some conjunctions, small values will take a very long time
         # and appropriate value of deltime depends on the velocity (altitude) of the satellite
-        ustarttime = (starttime-dt.datetime.utcfromtimestamp(0)).total_seconds()
-        uendtime = (endtime-dt.datetime.utcfromtimestamp(0)).total_seconds()
-        unix_time_array = np.arange(ustarttime, uendtime, self.deltime)
-        time_array = np.array([dt.datetime.utcfromtimestamp(ut) for ut in unix_time_array])
+        ustarttime = datetime2unix(starttime)
+        uendtime = datetime2unix(endtime)
 
-        sat_position = self.tle.sat_position(time_array).T
+        # each chunk is a section of np.arange(ustarttime, uendtime, deltime), formed the same way numpy does
+        nstep = max(int(np.ceil((uendtime-ustarttime)/self.deltime)), 0)
+        step = (ustarttime+self.deltime)-ustarttime
+        chunk = max(int(self.chunk_days*86400.//self.deltime), 1)
 
+        held = None
+        for i in range(0, nstep, chunk):
+            unix_time_array = ustarttime + np.arange(i, min(i+chunk, nstep))*step
+            passes = self.conjunctions_grid(unix_time_array, positions=positions)
 
-        # define site
+            # the pass held from the end of the last chunk continues if this chunk starts with a conjunction
+            if held is not None:
+                if passes and passes[0]['time'][0] == unix2datetime64(unix_time_array[0]).astype(dt.datetime):
+                    passes[0] = {k:np.concatenate([held[k], passes[0][k]]) for k in held}
+                else:
+                    yield held
+                held = None
+
+            if passes and passes[-1]['time'][-1] == unix2datetime64(unix_time_array[-1]).astype(dt.datetime):
+                held = passes.pop()
+            yield from passes
+
+        if held is not None:
+            yield held
+
+
+    def coarse_search(self, unix_time_array, year):
+        # return the indices of the times in unix_time_array that need to be checked for zenith conjunctions
+        # The times are split into runs that increase by about deltime (the whole grid from conjunctions(), or each AMISR
+        #   experiment), and each run into intervals of coarse_deltime.  The satellite position is only found at the start
+        #   of each interval, and an interval is kept if the satellite is within its maximum speed x the interval length
+        #   of the conjunction cone there, since it can't reach the cone within the interval otherwise.  Intervals where
+        #   the satellite changes TLE are always kept, as the position can jump at the change.
+        step = int(self.coarse_deltime//self.deltime)
+        if step < 2:
+            return np.arange(len(unix_time_array))
+
+        # the index range of each run is found from the gaps in time, and the intervals for all runs are formed at once
+        #   rather than searching the times separately for each run
+        diffs = np.diff(unix_time_array)
+        run_start = np.append(0, np.flatnonzero((diffs<=0.) | (diffs>1.5*self.deltime))+1)
+        run_end = np.append(run_start[1:], len(unix_time_array))
+        run_ncoarse = -((run_start-run_end)//step)
+        run_idx = np.repeat(np.arange(len(run_start)), run_ncoarse)
+        coarse_start = run_start[run_idx] + step*(np.arange(len(run_idx)) - np.repeat(np.cumsum(run_ncoarse)-run_ncoarse, run_ncoarse))
+        coarse_end = np.minimum(coarse_start+step, run_end[run_idx])-1
+        start_time = unix2datetime64(unix_time_array[coarse_start])
+        end_time = unix2datetime64(unix_time_array[coarse_end])
+
+        tle_idx = closest_midpoint_index(start_time, self.tle.TLE_epoch_midpoints)
+        tle_change = tle_idx != closest_midpoint_index(end_time, self.tle.TLE_epoch_midpoints)
+        margin = self.tle.TLE_max_speed[tle_idx]*(unix_time_array[coarse_end]-unix_time_array[coarse_start]+self.deltime)
+
+        _, _, zen_vec = self.site_reference(year)
+        sat_position = self.tle.sat_position(start_time).T
+        keep = zenith_mask(sat_position, self.site_coords, zen_vec, self.tolerance, margin=margin) | tle_change
+
+        # expand each kept interval to all of its steps
+        idx = coarse_start[keep][:,None] + np.arange(step)
+        return idx[idx<=coarse_end[keep][:,None]]
+
+
+    def site_reference(self, year):
+        # return the site latitude, longitude, and zenith direction (ECEF unit vector) in the conjunction coordinates
         if self.conjcoords == 'geo':
             site_lat = self.site_lat
             site_lon = self.site_lon
             zen_vec = self.site_zenith
         if self.conjcoords == 'mag':
-            A = Apex(starttime)
-            site_lat, site_lon = A.geo2apex(self.site_lat, self.site_lon, self.site_alt/1000.)
-            _,_,_,_,_,_, d1, d2, d3, e1, e2, e3 = A.basevectors_apex(self, self.site_lat, self.site_lon, self.site_alt/1000.)
-            zen_vec = np.array(pm.enu2uvw(e3[0], e3[1], e3[2], self.site_lat, self.site_lon))
-            zen_vec = zen_vec/np.linalg.norm(zen_vec)
+            # cached by year and site, so repeated searches don't redo the apex setup
+            site_lat, site_lon, zen_vec = site_apex_zenith(year, self.site_lat, self.site_lon, self.site_alt/1000.)
+        return site_lat, site_lon, zen_vec
 
-        if self.conjtype == 'zenith':
-            # Find vector to satelite and zenith angle
-            sat_vec = sat_position - self.site_coords
-            zenith_angle = np.arccos(np.einsum('...i,i->...',sat_vec, zen_vec)/np.linalg.norm(sat_vec,axis=1))*180./np.pi
 
-            # Find where zeith angle within tolerance
-            conjunctions = zenith_angle < self.tolerance
+    def conjunctions_grid(self, unix_time_array, segment=None, positions=True):
+        # find all passes of the satellite within tolerance of the site, checking the satellite position at each of the
+        #   (unix) times in unix_time_array
+        # segment = optional array of integer labels for each time (for example, which of several disjoint time periods it
+        #   belongs to).  Passes are also split wherever the label changes, and each pass records its 'segment'.
+        # positions = whether to include the satellite position for each pass
+        unix_time_array = np.asarray(unix_time_array)
+        if not len(unix_time_array):
+            return []
+        starttime = unix2datetime64(unix_time_array[0]).astype(dt.datetime)
+
+        # For zenith conjunctions, first check the satellite position only every coarse_deltime (a whole number of
+        #   deltime steps) and then check every step only in the coarse intervals where the satellite could be within
+        #   the conjunction cone.  The satellite is far from the site most of the time, so this skips almost all of
+        #   the propagations without missing any conjunctions (the result is the same as checking every step).
+        if self.conjtype == 'zenith' and self.coarse_deltime:
+            keep = self.coarse_search(unix_time_array, starttime.year)
+            unix_time_array = unix_time_array[keep]
+            if segment is not None:
+                segment = np.asarray(segment)[keep]
+            if not len(unix_time_array):
+                return []
+
+        # only the times of the conjunctions are converted to datetime objects for the output passes
+        time_array = unix2datetime64(unix_time_array)
+
+        sat_position = self.tle.sat_position(time_array).T
+
+
+        # define site
+        site_lat, site_lon, zen_vec = self.site_reference(starttime.year)
+
+        if self.conjtype == 'zenith':
+            # Find where zeith angle of the satelite is within tolerance
+            conjunctions = zenith_mask(sat_position, self.site_coords, zen_vec, self.tolerance)
 
         if self.conjtype == 'latlon':
             # Find satellite position in lat/lon coordinates
-            sat_lat, sat_lon, sat_alt = pm.ecef2geodetic(sat_position[:,0], sat_position[:,1], sat_position[:,2])
+            # The closed-form ecef2geodetic converts all positions in one pass (no iteration as in pymap3d), and the
+            #   result is only calculated once and reused for the apex conversion
+            sat_lat, sat_lon, sat_alt = ecef2geodetic(sat_position[:,0], sat_position[:,1], sat_position[:,2])
             if self.conjcoords == 'mag':
-                sat_lat, sat_lon = A.geo2apex(sat_lat, sat_lon, sat_alt/1000.)
+                # interpolated from a cached grid of apex coordinates rather than traced for every position
+                sat_lat, sat_lon = geo2apex(starttime.year, sat_lat, sat_lon, sat_alt/1000.)
 
-            # find all times satellite position is within tolerance of the radar position
-            conjunctions = np.all([np.abs(sat_lat-radar_lat)<latlontol[0],np.abs(sat_lon-radar_lon)<latlontol[1]], axis=0)
+            # find all times satellite position is within tolerance of the site position
+            # longitude differences are wrapped to [-180,180) so the box works across the 0/360 meridian
+            dlon = (sat_lon-site_lon+180.) % 360. - 180.
+            conjunctions = (np.abs(sat_lat-site_lat)<self.tolerance[0]) & (np.abs(dlon)<self.tolerance[1])
 
 
         # seperate individual passes
-        diffs = unix_time_array[conjunctions][1:]-unix_time_array[conjunctions][:-1]
-        jumps = np.argwhere(diffs>self.deltime).flatten()
+        # the indices of the conjunction times are split wherever there is a gap in time (or a change in segment), so
+        #   each pass is gathered from the full arrays once rather than re-indexing the conjunctions for every pass
+        conj_idx = np.flatnonzero(conjunctions)
+        # (gaps are compared with 1.5 deltime so rounding in the time grid doesn't split passes)
+        breaks = np.diff(unix_time_array[conj_idx]) > 1.5*self.deltime
+        if segment is not None:
+            breaks |= np.diff(segment[conj_idx]) != 0
 
-        if not jumps.size:
-            if not np.any(conjunctions):
-                # if no passes in experiment
-                passes = []
-            else:
-                # if only one pass in experiment
-                passes = [{'time':time_array[conjunctions],'position':sat_position[conjunctions][:]}]
-        else:
-            # first pass
-            passes = [{'time':time_array[conjunctions][:jumps[0]+1],'position':sat_position[conjunctions][:jumps[0]+1,:]}]
-            # all intermediate passes
-            for i in range(len(jumps)-1):
-                passes.append({'time':time_array[conjunctions][jumps[i]+1:jumps[i+1]+1],'position':sat_position[conjunctions][jumps[i]+1:jumps[i+1]+1,:]})
-            # last pass
-            passes.append({'time':time_array[conjunctions][jumps[-1]+1:],'position':sat_position[conjunctions][jumps[-1]+1:,:]})
+        def make_pass(idx):
+            # times (and positions) for the conjunctions at indices idx
+            p = {'time':time_array[idx].astype(dt.datetime)}
+            if positions:
+                p['position'] = sat_position[idx,:]
+            if segment is not None:
+                p['segment'] = segment[idx[0]]
+            return p
+
+        passes = [make_pass(idx) for idx in np.split(conj_idx, np.flatnonzero(breaks)+1)] if conj_idx.size else []
 
         return passes
+
+
+def datetime2unix(time):
+    # convert datetime(s) (or datetime64) to unix time (seconds), with numpy datetime64 arithmetic rather than
+    #   python timedelta.total_seconds()
+    return (np.asarray(time, dtype='datetime64[us]') - np.datetime64(0, 'us'))/np.timedelta64(1, 's')
+
+
+def unix2datetime64(unix_time_array):
+    # convert unix times (seconds) to a datetime64[us] array, rounded to the microsecond like utcfromtimestamp
+    # this is done in one cast rather than creating a datetime object for every time
+    return np.round(np.asarray(unix_time_array)*1.e6).astype(np.int64).astype('datetime64[us]')
+
+
+def zenith_mask(sat_position, site_coords, zen_vec, tolerance, margin=0.):
+    # Return a boolean array that is True where the zenith angle (in degrees) of each satellite position
+    #   (an (N,3) array of ECEF positions) from the site is less than tolerance
+    # The zenith angle itself is never calculated - the angle is within tolerance wherever the component of the
+    #   site-to-satellite vector along zen_vec is greater than cos(tolerance) times its length
+    # If margin (m, a scalar or one value per position) is given, positions within margin of the cone of zenith
+    #   angles less than tolerance are also True
+    position = np.ascontiguousarray(np.asarray(sat_position, dtype=np.float64).T)
+    site_coords = np.asarray(site_coords, dtype=np.float64)
+    zen_vec = np.asarray(zen_vec, dtype=np.float64)
+    margin = np.broadcast_to(np.asarray(margin, dtype=np.float64), position.shape[1])
+
+    mask = np.empty(position.shape[1], dtype=np.bool_)
+    tol = tolerance*np.pi/180.
+    _zenith_mask(position, site_coords[0], site_coords[1], site_coords[2], zen_vec[0], zen_vec[1], zen_vec[2], np.cos(tol), np.sin(tol), margin, mask)
+
+    return mask
+
+
+@njit(parallel=True, cache=True)
+def _zenith_mask(position, x0, y0, z0, zx, zy, zz, cos_tol, sin_tol, margin, out):
+    # The site-to-satellite vector, its projection on zen_vec, and its length are calculated for each position in
+    #   a single parallel loop, so none of the intermediate (sat_vec, dot product, norm, angle) arrays are allocated
+    # This is compiled without fastmath, which would let LLVM assume there are no NaNs - every comparison with a NaN
+    #   position (SGP4 error state) has to be False so it is never kept as a conjunction
+    for i in prange(position.shape[1]):
+        dx = position[0,i] - x0
+        dy = position[1,i] - y0
+        dz = position[2,i] - z0
+
+        dot = dx*zx + dy*zy + dz*zz
+        r = np.sqrt(dx*dx + dy*dy + dz*dz)
+
+        if dot > cos_tol*r:
+            out[i] = True
+        elif margin[i] > 0.:
+            # distance to the cone is r*sin(zenith angle - tolerance), or r if the closest point is the site itself
+            #   (zenith angle - tolerance > 90 degrees), written in terms of the components along and perpendicular
+            #   to zen_vec so no trig is needed
+            perp = np.sqrt(max(r*r - dot*dot, 0.))
+            if dot*cos_tol + perp*sin_tol < 0.:
+                out[i] = r <= margin[i]
+            else:
+                out[i] = perp*cos_tol - dot*sin_tol <= margin[i]
+        else:
+            out[i] = False
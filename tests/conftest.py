@@ -0,0 +1,5 @@
+# The modules are run as scripts from the repository directory rather than installed, so make them importable
+#   from the tests
+import sys
+import pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
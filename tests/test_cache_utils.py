@@ -0,0 +1,37 @@
+import numpy as np
+import pickle
+import pytest
+
+from cache_utils import atomic_write, save_npz_cache, cache_load_errors
+
+
+def test_save_npz_cache(tmp_path):
+    cache_file = tmp_path.joinpath('sub', 'cache.npz')
+    save_npz_cache(cache_file, compressed=True, a=np.arange(5))
+    with np.load(cache_file) as cache:
+        np.testing.assert_array_equal(cache['a'], np.arange(5))
+    assert [f.name for f in cache_file.parent.iterdir()] == ['cache.npz']
+
+
+def test_atomic_write_keeps_old_file(tmp_path):
+    cache_file = tmp_path.joinpath('cache.pkl')
+    with atomic_write(cache_file) as f:
+        pickle.dump('old', f)
+
+    # a write that fails part way through leaves the previous file (and no temporary file) behind
+    with pytest.raises(RuntimeError):
+        with atomic_write(cache_file) as f:
+            f.write(b'partial')
+            raise RuntimeError
+    with open(cache_file, 'rb') as f:
+        assert pickle.load(f) == 'old'
+    assert [f.name for f in tmp_path.iterdir()] == ['cache.pkl']
+
+
+@pytest.mark.parametrize('contents', [b'', b'PK\x03\x04truncated'])
+def test_corrupt_npz_is_a_cache_miss(tmp_path, contents):
+    cache_file = tmp_path.joinpath('cache.npz')
+    cache_file.write_bytes(contents)
+    with pytest.raises(cache_load_errors):
+        with np.load(cache_file) as cache:
+            cache['a']
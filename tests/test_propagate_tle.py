@@ -0,0 +1,53 @@
+import numpy as np
+import datetime as dt
+import pymap3d as pm
+import pytest
+
+from propagate_tle import ecef2geodetic, propagate_tle
+
+
+def test_ecef2geodetic_matches_pymap3d():
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-90., 90., 1000)
+    lon = rng.uniform(-180., 180., 1000)
+    alt = rng.uniform(0., 4.e7, 1000)
+    glat, glon, galt = ecef2geodetic(*pm.geodetic2ecef(lat, lon, alt))
+    np.testing.assert_allclose(glat, lat, atol=1.e-9)
+    np.testing.assert_allclose(glon, lon, atol=1.e-9)
+    np.testing.assert_allclose(galt, alt, atol=1.e-5)
+
+
+def test_ecef2geodetic_polar_axis():
+    # points on (and next to) the polar axis, where x=y=0
+    x = np.array([0., 0., 1.e-3, 1.])
+    y = np.zeros(4)
+    z = np.array([6.86e6, -7.e6, 6.4e6, -6.4e6])
+    glat, glon, galt = ecef2geodetic(x, y, z)
+    lat, lon, alt = pm.ecef2geodetic(x, y, z)
+    np.testing.assert_allclose(glat, lat, atol=1.e-9)
+    np.testing.assert_allclose(glat[:2], [90., -90.])
+    np.testing.assert_allclose(galt, alt, atol=1.e-5)
+
+
+def test_ecef2geodetic_nan():
+    # a NaN position (SGP4 error state) only affects its own element
+    x = np.array([7.e6, np.nan, 5.e6])
+    y = np.array([0., 1.e6, 1.e6])
+    z = np.array([1.e6, 1.e6, 4.e6])
+    glat, glon, galt = ecef2geodetic(x, y, z)
+    assert np.all(np.isnan([glat[1], glon[1], galt[1]]))
+    lat, lon, alt = pm.ecef2geodetic(x[[0,2]], y[[0,2]], z[[0,2]])
+    np.testing.assert_allclose(glat[[0,2]], lat, atol=1.e-9)
+    np.testing.assert_allclose(glon[[0,2]], lon, atol=1.e-9)
+    np.testing.assert_allclose(galt[[0,2]], alt, atol=1.e-5)
+
+
+def test_propagate_tle_frames():
+    TLE = ['1     1U          18350.30892361  .00001123  00000-0  66525-4 0   109','2     1  85.0373 178.2871 0002550 225.5672 175.5175 15.21584957    13']
+    times = np.array([dt.datetime(2018,12,17,0,0,0)+dt.timedelta(hours=h) for h in range(24)])
+    pef = propagate_tle(times, TLE)
+    assert pef.shape == (3, 24)
+    assert propagate_tle(times, TLE, frame='teme').shape == (3, 24)
+    np.testing.assert_allclose(propagate_tle(times, TLE, frame='geodetic'), ecef2geodetic(*pef), atol=1.e-6)
+    with pytest.raises(ValueError):
+        propagate_tle(times, TLE, frame='ecef')
@@ -0,0 +1,75 @@
+import numpy as np
+import datetime as dt
+import pymap3d as pm
+import pytest
+
+import propagate_tle
+import satellite_conjunction
+from satellite_conjunction import SatConj, zenith_mask
+
+
+# ISS TLEs returned in place of a space-track.org query
+TLES = ['1 25544U 98067A   18350.51782528  .00001264  00000-0  26994-4 0  9993','2 25544  51.6412 203.4188 0002184 196.1703 286.2338 15.54003269146899',
+        '1 25544U 98067A   18351.51782528  .00001264  00000-0  26994-4 0  9993','2 25544  51.6412 203.4188 0002184 196.1703 286.2338 15.54003269146899',
+        '1 25544U 98067A   18352.01782528  .00001264  00000-0  26994-4 0  9993','2 25544  51.6412 203.4188 0002184 196.1703 286.2338 15.54003269146899']
+
+
+class FakeSpaceTrackClient(object):
+    def __init__(self, identity=None, password=None):
+        pass
+
+    def tle(self, **kwargs):
+        return '\n'.join(TLES)+'\n'
+
+
+@pytest.fixture
+def satconj(monkeypatch, tmp_path):
+    monkeypatch.setattr(propagate_tle, 'SpaceTrackClient', FakeSpaceTrackClient)
+    monkeypatch.setattr(propagate_tle, 'tle_library_dir', tmp_path)
+
+    # count the satellite positions calculated
+    calls = []
+    sat_position = propagate_tle.TLEHandler.sat_position
+    def counting_sat_position(self, time_array):
+        calls.append(len(time_array))
+        return sat_position(self, time_array)
+    monkeypatch.setattr(satellite_conjunction.TLEHandler, 'sat_position', counting_sat_position)
+
+    def make(**kwargs):
+        return SatConj(45., -75., 0., 25544, **kwargs)
+    return make, calls
+
+
+@pytest.mark.parametrize('deltime', [10., 60.])
+def test_coarse_search_matches_full_search(satconj, deltime):
+    make, calls = satconj
+    starttime = dt.datetime(2018,12,15)
+    endtime = dt.datetime(2018,12,19)
+
+    sc = make(deltime=deltime)
+    assert sc.coarse_deltime >= 2*sc.deltime
+    coarse = sc.conjunctions(starttime, endtime)
+    ncoarse = sum(calls)
+
+    del calls[:]
+    sc.coarse_deltime = 0
+    full = sc.conjunctions(starttime, endtime)
+    nfull = sum(calls)
+
+    # the coarse search skips most of the positions, but finds the same passes
+    assert nfull == len(np.arange(0., (endtime-starttime).total_seconds(), deltime))
+    assert ncoarse < 0.5*nfull
+    assert len(full) > 0
+    assert len(coarse) == len(full)
+    for c, f in zip(coarse, full):
+        assert np.array_equal(c['time'], f['time'])
+        np.testing.assert_array_equal(c['position'], f['position'])
+
+
+def test_zenith_mask_nan():
+    # NaN positions (SGP4 error state) are never within the cone, even with a margin
+    site = np.array(pm.geodetic2ecef(45., -75., 0.))
+    zen_vec = np.array(pm.enu2uvw(0., 0., 1., 45., -75.))
+    position = np.array([site+5.e5*zen_vec, [np.nan, 0., 0.], [np.nan, np.nan, np.nan], site+[1.e7, 0., 0.]])
+    np.testing.assert_array_equal(zenith_mask(position, site, zen_vec, 25.), [True, False, False, False])
+    np.testing.assert_array_equal(zenith_mask(position, site, zen_vec, 25., margin=1.e8), [True, False, False, True])
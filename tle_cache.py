@@ -0,0 +1,84 @@
+# tle_cache.py
+# Retrieve TLEs for a satellite and period from space-track.org, keeping a copy on disk.
+# space-track.org is slow and rate limits API calls, so repeated requests for the same satellite and period
+#   (for example, re-running a script) are read from the cache instead.
+# Each cache file is an .npz archive holding the TLE lines as fixed width byte strings along with the parsed
+#   epochs, so a cached period doesn't have to be split into lines or have its epochs parsed again.
+
+import numpy as np
+import datetime as dt
+import pathlib
+import re
+from spacetrack import SpaceTrackClient
+import spacetrack.operators as op
+from propagate_tle import tle_epoch
+from cache_utils import save_npz_cache, cache_load_errors
+
+from space_track_credentials import *
+
+tle_cache_dir = pathlib.Path.home().joinpath('.cache', 'tle')
+
+
+# matches each TLE (line 1 and line 2) in a space-track.org response, capturing the NORAD ID from line 1
+tle_pattern = re.compile(r'^(1 ([ \d]{5})[^\r\n]*)\r?\n(2 [^\r\n]*)', re.MULTILINE)
+
+
+def get_tles(sid, startdate, enddate, return_epoch=False):
+    # return a list of TLEs ([TLE line 1, TLE line 2]) with epochs from startdate to enddate for NORAD satellite ID sid
+    # if return_epoch is True, also return the epoch of each TLE (as from propagate_tle.tle_epoch())
+    return get_tles_many([sid], startdate, enddate, return_epoch=return_epoch)[sid]
+
+
+def get_tles_many(sids, startdate, enddate, return_epoch=False):
+    # return a dictionary of TLE lists (as returned by get_tles()) for each NORAD satellite ID in sids
+    # all satellites that aren't already cached are retrieved from space-track.org with a single API call
+
+    # if start and end times on the same date, advance enddate by one day
+    if startdate==enddate:
+        enddate = enddate + dt.timedelta(days=1)
+
+    output = dict()
+    missing = list()
+    for sid in sids:
+        try:
+            with np.load(tle_cache_file(sid, startdate, enddate)) as cache:
+                output[sid] = (cache['line1'], cache['line2'], cache['epoch'])
+        except cache_load_errors:
+            missing.append(sid)
+
+    if missing:
+        # retrieve TLEs for entire period from space-track.org
+        st = SpaceTrackClient(identity=ST_USERNAME, password=ST_PASSWORD)
+        response = st.tle(norad_cat_id=missing, orderby='epoch asc', epoch=op.inclusive_range(startdate,enddate), format='tle')
+
+        # split the response by satellite in a single pass over the text
+        split = {sid:[] for sid in missing}
+        for m in tle_pattern.finditer(response):
+            split.setdefault(int(m.group(2)), []).append((m.group(1), m.group(3)))
+
+        for sid in missing:
+            TLE_list = split[sid]
+            line1 = np.array([tle[0] for tle in TLE_list], dtype='S69')
+            line2 = np.array([tle[1] for tle in TLE_list], dtype='S69')
+            output[sid] = (line1, line2, tle_epoch(TLE_list))
+
+            # only cache periods that are over - new TLEs may still be published for recent dates
+            if enddate < dt.datetime.utcnow().date():
+                cache_file = tle_cache_file(sid, startdate, enddate)
+                try:
+                    save_npz_cache(cache_file, line1=line1, line2=line2, epoch=output[sid][2])
+                except OSError:
+                    print('Could not write TLE cache file {}'.format(cache_file))
+
+    # convert to lists of distinct TLEs
+    TLE_dict = dict()
+    for sid in sids:
+        line1, line2, epoch = output[sid]
+        TLE_list = [[l1, l2] for l1, l2 in zip(line1.astype('U69').tolist(), line2.astype('U69').tolist())]
+        TLE_dict[sid] = (TLE_list, epoch) if return_epoch else TLE_list
+
+    return TLE_dict
+
+
+def tle_cache_file(sid, startdate, enddate):
+    return tle_cache_dir.joinpath('{}_{:%Y%m%d}_{:%Y%m%d}.npz'.format(sid, startdate, enddate))